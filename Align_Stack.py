@@ -0,0 +1,248 @@
+import os
+import json
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from photutils.detection import find_peaks
+from photutils.centroids import centroid_com, centroid_sources
+from scipy import ndimage
+from Intermediate_Storage import read_frame, frame_files
+from Frame_Combine import combine_frames, DiskStack
+from Metrics import timer, count_bytes
+from Main import reduction_dir
+
+# Alignment and stacking of the reduced frames written by Data_Reduction.py into the
+# "Normalized Aligned Stacked Images" that NewAperturePhotometry.py measures.
+# Each frame is registered against the first frame of its group: FFT phase correlation on block-averaged
+# images gives the coarse shift, then the centroids of the brightest reference stars refine it to a
+# fraction of a pixel. The shifts are cached on disk (keyed on the file's size/mtime and the reference),
+# so restacking with other combine parameters skips the registration. Reduced frames can be in any of
+# the Intermediate_Storage formats.
+
+reduced_image_dir = os.path.join(reduction_dir, 'Reduced Image')
+stacked_image_dir = os.path.join(reduction_dir, 'Normalized Aligned Stacked Images')
+alignment_cache_path = os.path.join(reduction_dir, 'alignment_cache.json')
+
+OBJECTS = ['M52', 'NGC7789', 'Standard Star 1', 'Standard Star 2']
+BANDS = ['B-band', 'U-band', 'V-band']
+OBSERVATIONS = ['First observation', 'Second observation', 'Third observation']
+
+
+def downsample(data, factor):
+    """Block average by factor in both axes (edges that don't fill a block are dropped)."""
+    rows = data.shape[0] // factor * factor
+    cols = data.shape[1] // factor * factor
+    blocks = np.asarray(data[:rows, :cols], dtype=np.float32).reshape(rows // factor, factor, cols // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def correlation_image(data, factor):
+    # Downsampled, background-subtracted and clipped at zero so the stars, not the sky, drive the correlation
+    small = downsample(data, factor)
+    _, median, _ = sigma_clipped_stats(small, sigma=3.0, maxiters=3)
+    return np.clip(small - median, 0, None)
+
+
+def phase_correlation(reference_fft, image_fft, shape):
+    """(dx, dy) shift of the image relative to the reference, in (downsampled) pixels.
+
+    Both arguments are rfft2 transforms of images of the given shape."""
+    cross_power = reference_fft * np.conj(image_fft)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=shape)
+    peak_y, peak_x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # The correlation peaks at minus the shift, wrapped around the image
+    ny, nx = correlation.shape
+    dy = -peak_y if peak_y <= ny // 2 else ny - peak_y
+    dx = -peak_x if peak_x <= nx // 2 else nx - peak_x
+    return dx, dy
+
+
+def sky_subtracted(data):
+    # Centroids are taken on the sky-subtracted frame, otherwise the sky pulls them to the box centre
+    _, median, std = sigma_clipped_stats(data, sigma=3.0, maxiters=3)
+    return np.asarray(data, dtype=np.float32) - median, std
+
+
+def reference_stars(data, n_stars=50, box_size=11, border=32):
+    """(x, y) of the brightest local maxima of a frame, used to refine the shift."""
+    data, std = sky_subtracted(data)
+    peaks = find_peaks(data, 5.0 * std, box_size=box_size, border_width=border)
+    if peaks is None or len(peaks) == 0:
+        return np.empty(0), np.empty(0)
+    peaks.sort('peak_value', reverse=True)
+    peaks = peaks[:n_stars]
+    x, y = centroid_sources(data, peaks['x_peak'], peaks['y_peak'], box_size=box_size, centroid_func=centroid_com)
+    return np.asarray(x), np.asarray(y)
+
+
+def refine_shift(data, ref_x, ref_y, dx, dy, box_size=11):
+    """Sub-pixel shift: median offset of the reference stars' centroids at their predicted positions."""
+    x_guess = ref_x + dx
+    y_guess = ref_y + dy
+    inside = ((x_guess > box_size) & (x_guess < data.shape[1] - box_size) &
+              (y_guess > box_size) & (y_guess < data.shape[0] - box_size))
+    if inside.sum() < 3:
+        return dx, dy
+    data, _ = sky_subtracted(data)
+    x, y = centroid_sources(data, x_guess[inside], y_guess[inside], box_size=box_size, centroid_func=centroid_com)
+    offsets_x = np.asarray(x) - ref_x[inside]
+    offsets_y = np.asarray(y) - ref_y[inside]
+    good = np.isfinite(offsets_x) & np.isfinite(offsets_y)
+    if good.sum() < 3:
+        return dx, dy
+    return float(np.median(offsets_x[good])), float(np.median(offsets_y[good]))
+
+
+class FrameAligner:
+    def __init__(self, cache_path=alignment_cache_path, factor=4, n_stars=50):
+        self.cache_path = cache_path
+        self.factor = factor
+        self.n_stars = n_stars
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+        self._reference = None  # (path, fft and shape of the correlation image, star x, star y)
+
+    def save_cache(self):
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(self.cache_path, 'w') as f:
+            json.dump(self.cache, f, indent=1)
+
+    def _file_key(self, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _set_reference(self, reference_path):
+        if self._reference is not None and self._reference[0] == reference_path:
+            return
+        data, _ = read_frame(reference_path)
+        small = correlation_image(data, self.factor)
+        ref_x, ref_y = reference_stars(data, self.n_stars)
+        self._reference = (reference_path, np.fft.rfft2(small), small.shape, ref_x, ref_y)
+
+    def transform(self, path, reference_path):
+        """(dx, dy) of the frame at path relative to the reference frame, from the cache when still valid."""
+        key = {'file': self._file_key(path), 'reference': reference_path,
+               'reference_file': self._file_key(reference_path), 'factor': self.factor}
+        cached = self.cache.get(path)
+        if cached is not None and cached['key'] == key:
+            return cached['dx'], cached['dy']
+
+        if path == reference_path:
+            dx, dy = 0.0, 0.0
+        else:
+            self._set_reference(reference_path)
+            _, reference_fft, shape, ref_x, ref_y = self._reference
+            data, _ = read_frame(path)
+            image_fft = np.fft.rfft2(correlation_image(data, self.factor))
+            coarse_dx, coarse_dy = phase_correlation(reference_fft, image_fft, shape)
+            dx, dy = refine_shift(data, ref_x, ref_y, coarse_dx * self.factor, coarse_dy * self.factor)
+        self.cache[path] = {'key': key, 'dx': dx, 'dy': dy}
+        return dx, dy
+
+
+def normalisation(header):
+    # Frames are normalised to counts per second so observations with different exposures stack together
+    exptime = header.get('EXPTIME')
+    try:
+        exptime = float(exptime)
+    except (TypeError, ValueError):
+        exptime = 0.0
+    return exptime if exptime > 0 else 1.0
+
+
+def align_and_stack(frame_paths, output_path, aligner, method='median', workers=1, **combine_options):
+    """Align frame_paths on the first one, normalise them by EXPTIME and write the combined stack."""
+    frame_paths = sorted(frame_paths)
+    reference_path = frame_paths[0]
+    with timer('align.register'):
+        transforms = [aligner.transform(path, reference_path) for path in frame_paths]
+        aligner.save_cache()
+
+    reference_data, reference_header = read_frame(reference_path)
+    airmasses = []
+    exptimes = []
+    with DiskStack(len(frame_paths), reference_data.shape) as stack:
+        for i, (path, (dx, dy)) in enumerate(zip(frame_paths, transforms)):
+            data, header = read_frame(path)
+            exptime = normalisation(header)
+            exptimes.append(exptime)
+            if 'AIRMASS' in header:
+                airmasses.append(float(header['AIRMASS']))
+            # Uncovered edges become NaN; the NaN-aware combine leaves them out, so an edge pixel is the
+            # combination of the frames that do cover it
+            with timer('stack.shift'):
+                stack[i] = ndimage.shift(np.asarray(data, dtype=np.float32) / exptime, (-dy, -dx),
+                                         order=1, mode='constant', cval=np.nan)
+            count_bytes('stack.shift', data.nbytes)
+        with timer('stack.combine'):
+            stacked = combine_frames(stack.frames, method=method, dtype=np.float32, workers=workers,
+                                     ignore_nan=True, **combine_options)
+
+    # Only pixels no frame covers are still NaN; fill them with the sky level so the photometry's
+    # statistics and detection see an ordinary background there
+    uncovered = ~np.isfinite(stacked)
+    if uncovered.any():
+        stacked[uncovered] = np.nanmedian(stacked)
+
+    header = reference_header.copy()
+    header['NCOMBINE'] = (len(frame_paths), 'Number of frames stacked')
+    header['STACKMTH'] = (method, 'Combine method')
+    header['EXPTOTAL'] = (float(np.sum(exptimes)), 'Total exposure time of the stack [s]')
+    header['BUNIT'] = 'counts/s'
+    if airmasses:
+        header['AIRMASS'] = (float(np.mean(airmasses)), 'Mean airmass of the stacked frames')
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with timer('stack.write'):
+        fits.PrimaryHDU(stacked, header=header).writeto(output_path, overwrite=True)
+    print(f"Stacked {len(frame_paths)} frames into {output_path}")
+    return stacked
+
+
+def stack_output_path(obj_name, band, observation=None, output_dir=stacked_image_dir):
+    # Same names as the reduced_image_paths list in NewAperturePhotometry.py
+    if observation is None:
+        return os.path.join(output_dir, obj_name, band, f"{obj_name}_normalized_Stacked_{band}.fits")
+    observation = observation.replace('observation', 'Observation')
+    short_name = 'SS' + obj_name.split()[-1]
+    return os.path.join(output_dir, obj_name, band, observation,
+                        f"{short_name} normalized_Stacked_{observation} {band[0]}.fits")
+
+
+def reduced_frames(obj_name, band, observation=None, input_dir=reduced_image_dir, storage='fits'):
+    parts = [input_dir, obj_name, band] + ([observation] if observation else [])
+    frame_dir = os.path.join(*parts)
+    if not os.path.isdir(frame_dir):
+        return []
+    return frame_files(frame_dir, storage)
+
+
+def stack_all(method='median', aligner=None, input_dir=reduced_image_dir, output_dir=stacked_image_dir, workers=1,
+              storage='fits'):
+    """Align and stack every object/band (and standard-star observation) found in input_dir.
+
+    storage is the format the reduced frames were written in (see Intermediate_Storage.py); only frames
+    in that format are stacked.
+    """
+    aligner = aligner or FrameAligner()
+    outputs = []
+    for obj_name in OBJECTS:
+        observations = OBSERVATIONS if obj_name.startswith('Standard Star') else [None]
+        for band in BANDS:
+            for observation in observations:
+                frame_paths = reduced_frames(obj_name, band, observation, input_dir, storage)
+                if not frame_paths:
+                    continue
+                output_path = stack_output_path(obj_name, band, observation, output_dir)
+                align_and_stack(frame_paths, output_path, aligner, method=method, workers=workers)
+                outputs.append(output_path)
+    return outputs
+
+
+if __name__ == "__main__":
+    stack_all()
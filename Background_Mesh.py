@@ -0,0 +1,81 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from astropy.stats import sigma_clipped_stats
+from scipy.ndimage import median_filter
+from scipy.interpolate import RectBivariateSpline
+
+# Spatially varying sky background and noise. The image is divided into box_size x box_size boxes and the
+# sigma-clipped median and standard deviation of every box are computed, one strip of boxes per task in a
+# thread pool (each strip is reshaped to (n_boxes, box pixels) and clipped along the last axis, so there
+# is no loop over boxes). A median filter over the coarse grid removes boxes pulled up by a bright star,
+# and a bicubic spline through the box centres gives smooth full-resolution background and RMS maps.
+# Detection then thresholds against the local RMS instead of one global standard deviation, which is
+# both faster than clipping the whole 4k frame at once and right where the sky has gradients.
+
+DEFAULT_BOX_SIZE = 128
+DEFAULT_FILTER_SIZE = 3
+
+
+def _strip_statistics(strip, box_size, sigma, maxiters):
+    # Clipped median and std of every box of one strip of box_size rows (NaN pads the partial boxes)
+    n_rows, width = strip.shape
+    n_boxes = -(-width // box_size)
+    padded = np.full((box_size, n_boxes * box_size), np.nan, dtype=np.float32)
+    padded[:n_rows, :width] = strip
+    boxes = padded.reshape(box_size, n_boxes, box_size).transpose(1, 0, 2).reshape(n_boxes, -1)
+    _, median, std = sigma_clipped_stats(boxes, mask=~np.isfinite(boxes), sigma=sigma, maxiters=maxiters, axis=1)
+    return np.asarray(median), np.asarray(std)
+
+
+def mesh_statistics(data, box_size=DEFAULT_BOX_SIZE, sigma=3.0, maxiters=5, workers=None):
+    """(background, rms) grids: the clipped median and std of every box, one row per strip of boxes."""
+    strips = [data[start:start + box_size] for start in range(0, data.shape[0], box_size)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = list(pool.map(lambda strip: _strip_statistics(strip, box_size, sigma, maxiters), strips))
+    background = np.array([median for median, _ in results])
+    rms = np.array([std for _, std in results])
+    return background, rms
+
+
+def _fill_and_filter(grid, filter_size):
+    # Boxes that were entirely masked or NaN take the median of the others; then smooth out outlier boxes
+    bad = ~np.isfinite(grid)
+    if bad.all():
+        return np.zeros_like(grid)
+    if bad.any():
+        grid = np.where(bad, np.nanmedian(grid), grid)
+    if filter_size > 1:
+        grid = median_filter(grid, size=filter_size, mode='nearest')
+    return grid
+
+
+def interpolate_mesh(grid, shape, box_size):
+    """Full-resolution map through the box centres, bicubic where the grid allows and flat beyond the
+    outermost centres."""
+    centres = []
+    for axis in range(2):
+        centres.append(np.minimum((np.arange(grid.shape[axis]) + 0.5) * box_size, shape[axis] - 0.5))
+        if grid.shape[axis] == 1:
+            # A single box along this axis: make it constant along it, the spline needs two points
+            grid = np.repeat(grid, 2, axis=axis)
+            centres[axis] = np.array([0.0, shape[axis] - 1.0])
+    y_centres, x_centres = centres
+    spline = RectBivariateSpline(y_centres, x_centres, grid, kx=min(3, grid.shape[0] - 1),
+                                 ky=min(3, grid.shape[1] - 1))
+    y = np.clip(np.arange(shape[0]), y_centres[0], y_centres[-1])
+    x = np.clip(np.arange(shape[1]), x_centres[0], x_centres[-1])
+    return spline(y, x).astype(np.float32)
+
+
+def background_maps(data, box_size=DEFAULT_BOX_SIZE, filter_size=DEFAULT_FILTER_SIZE, sigma=3.0, maxiters=5,
+                    workers=None):
+    """Smooth background and RMS maps (float32, the shape of data) from clipped statistics on a grid.
+
+    box_size should be several times the FWHM so stars are clipped out of every box, and small enough
+    to follow the sky gradients.
+    """
+    background, rms = mesh_statistics(data, box_size, sigma, maxiters, workers)
+    background = _fill_and_filter(background, filter_size)
+    rms = _fill_and_filter(rms, filter_size)
+    return interpolate_mesh(background, data.shape, box_size), interpolate_mesh(rms, data.shape, box_size)
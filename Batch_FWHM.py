@@ -0,0 +1,206 @@
+import numpy as np
+from astropy.stats import sigma_clip
+from scipy.interpolate import RegularGridInterpolator
+from scipy.special import erf
+
+# PSF widths of many stars at once. The fit_shape x fit_shape cutouts of all stars are gathered into one
+# (n_stars, fit_shape, fit_shape) array, moments give every star's starting point, and a circular Gaussian
+# integrated over each pixel (flux, x0, y0, sigma and optionally a constant background) is fitted to every
+# cutout together with a batched Levenberg-Marquardt: each iteration builds the (n_stars, n_params, n_params)
+# normal equations with einsum and solves them in one np.linalg.solve call, so there is no Python loop
+# over stars. This is the pixel-integrated Gaussian that photutils' fit_fwhm fits one star at a time, so
+# the widths agree with it.
+#
+# fwhm_grid() and interpolate_fwhm() turn the per-star widths into a FWHM map across the field, for
+# images where the PSF changes from the centre to the corners.
+
+GAUSSIAN_SIGMA_TO_FWHM = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+
+def extract_cutouts(data, positions, size):
+    """(n, size, size) cutouts centred on the rounded positions (NaN outside the image) and the
+    (x, y) pixel coordinates of every cutout's lower-left pixel."""
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    half = size // 2
+    x_origin = np.round(positions[:, 0]).astype(int) - half
+    y_origin = np.round(positions[:, 1]).astype(int) - half
+    offsets = np.arange(size)
+    px, py = np.broadcast_arrays(x_origin[:, None, None] + offsets[None, None, :],
+                                 y_origin[:, None, None] + offsets[None, :, None])
+    inside = (px >= 0) & (px < data.shape[1]) & (py >= 0) & (py < data.shape[0])
+    cutouts = np.full(px.shape, np.nan)
+    cutouts[inside] = data[py[inside], px[inside]]
+    return cutouts, np.column_stack((x_origin, y_origin))
+
+
+def moment_guess(cutouts, fit_background=False):
+    """Starting parameters (flux, x0, y0, sigma[, background]) of every cutout from its moments."""
+    size = cutouts.shape[1]
+    y, x = np.mgrid[:size, :size]
+    if fit_background:
+        edge = np.concatenate((cutouts[:, 0, :], cutouts[:, -1, :], cutouts[:, 1:-1, 0], cutouts[:, 1:-1, -1]), axis=1)
+        background = np.nanmedian(edge, axis=1)
+    else:
+        background = np.zeros(len(cutouts))
+    signal = np.nan_to_num(cutouts - background[:, None, None])
+    weights = np.clip(signal, 0, None)
+    total = weights.sum(axis=(1, 2))
+    total = np.where(total > 0, total, 1.0)
+    x0 = (weights * x).sum(axis=(1, 2)) / total
+    y0 = (weights * y).sum(axis=(1, 2)) / total
+    r2 = (x - x0[:, None, None]) ** 2 + (y - y0[:, None, None]) ** 2
+    sigma = np.sqrt(np.clip((weights * r2).sum(axis=(1, 2)) / total / 2.0, 0.25, None))
+    flux = np.maximum(signal.sum(axis=(1, 2)), np.nanmax(signal, axis=(1, 2)))
+    parameters = [flux, x0, y0, sigma] + ([background] if fit_background else [])
+    return np.column_stack(parameters)
+
+
+def _pixel_integral(coordinate, centre, sigma):
+    # Fraction of a 1-D Gaussian falling in every pixel, and its derivatives by the centre and by sigma
+    scale = np.sqrt(2.0) * sigma
+    upper = (coordinate[None, :] + 0.5 - centre) / scale
+    lower = (coordinate[None, :] - 0.5 - centre) / scale
+    value = 0.5 * (erf(upper) - erf(lower))
+    exp_upper = np.exp(-upper ** 2) / np.sqrt(np.pi)
+    exp_lower = np.exp(-lower ** 2) / np.sqrt(np.pi)
+    d_centre = (exp_lower - exp_upper) / scale
+    d_sigma = (exp_lower * lower - exp_upper * upper) / sigma
+    return value, d_centre, d_sigma
+
+
+def _gaussian(parameters, x, y):
+    # Model and Jacobian of every cutout, with the pixels flattened: (n, n_pix) and (n, n_pix, n_params)
+    flux, x0, y0, sigma = (parameters[:, i, None] for i in range(4))
+    ex, ex_centre, ex_sigma = _pixel_integral(x, x0, sigma)
+    ey, ey_centre, ey_sigma = _pixel_integral(y, y0, sigma)
+    g = ex * ey
+    model = flux * g
+    columns = [g, flux * ex_centre * ey, flux * ex * ey_centre, flux * (ex_sigma * ey + ex * ey_sigma)]
+    if parameters.shape[1] == 5:
+        model = model + parameters[:, 4, None]
+        columns.append(np.ones_like(g))
+    return model, np.stack(columns, axis=2)
+
+
+def fit_gaussians(cutouts, fit_background=False, max_iterations=50, tolerance=1e-6):
+    """Batched Levenberg-Marquardt fit of a pixel-integrated circular Gaussian to every cutout.
+
+    Returns (parameters, converged): an (n, 4 or 5) array of flux, x0, y0, sigma (cutout pixel
+    coordinates) and background, and which fits ended on a star-like solution. NaN pixels are left out.
+    """
+    n, size, _ = cutouts.shape
+    y, x = np.mgrid[:size, :size]
+    x = x.ravel().astype(float)
+    y = y.ravel().astype(float)
+    values = cutouts.reshape(n, -1)
+    valid = np.isfinite(values)
+    values = np.where(valid, values, 0.0)
+
+    parameters = moment_guess(cutouts, fit_background)
+    damping = np.full(n, 1e-3)
+    model, jacobian = _gaussian(parameters, x, y)
+    residual = np.where(valid, values - model, 0.0)
+    chi2 = np.sum(residual ** 2, axis=1)
+    active = np.ones(n, dtype=bool)
+    n_params = parameters.shape[1]
+
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        j = jacobian[active] * valid[active][:, :, None]
+        normal = np.einsum('npi,npj->nij', j, j)
+        gradient = np.einsum('npi,np->ni', j, residual[active])
+        diagonal = np.maximum(np.diagonal(normal, axis1=1, axis2=2), 1e-12)
+        damped = normal + (damping[active, None] * diagonal)[:, :, None] * np.eye(n_params)[None]
+        damped[:, np.arange(n_params), np.arange(n_params)] += 1e-12
+        step = np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+
+        trial = parameters[active] + step
+        trial_model, trial_jacobian = _gaussian(trial, x, y)
+        trial_residual = np.where(valid[active], values[active] - trial_model, 0.0)
+        trial_chi2 = np.sum(trial_residual ** 2, axis=1)
+        better = np.isfinite(trial_chi2) & (trial_chi2 < chi2[active])
+
+        # Accept improving steps and relax the damping, otherwise damp harder
+        index = np.flatnonzero(active)
+        accepted = index[better]
+        relative_change = (chi2[accepted] - trial_chi2[better]) / np.maximum(chi2[accepted], 1e-30)
+        parameters[accepted] = trial[better]
+        model[accepted] = trial_model[better]
+        jacobian[accepted] = trial_jacobian[better]
+        residual[accepted] = trial_residual[better]
+        chi2[accepted] = trial_chi2[better]
+        damping[accepted] /= 10.0
+        damping[index[~better]] *= 10.0
+
+        # A fit is done when a step barely changes chi2 or no damping finds a better point (it is at the minimum)
+        done = np.zeros(n, dtype=bool)
+        done[accepted[relative_change < tolerance]] = True
+        done |= damping > 1e10
+        active &= ~done
+
+    # Converged to a star-like solution: positive flux and width, centre inside the cutout
+    converged = np.all(np.isfinite(parameters), axis=1) & (parameters[:, 0] > 0) & (parameters[:, 3] > 0)
+    converged &= (parameters[:, 1] >= 0) & (parameters[:, 1] <= size - 1)
+    converged &= (parameters[:, 2] >= 0) & (parameters[:, 2] <= size - 1)
+    return parameters, converged
+
+
+def batch_fwhm(data, positions, fit_shape=7, fit_background=False):
+    """FWHM of the star at every (x, y) position, NaN where the fit failed.
+
+    data should be background subtracted unless fit_background is set. Returns (fwhm, x, y) with the
+    fitted centres in image pixel coordinates.
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    if len(positions) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+    cutouts, origins = extract_cutouts(data, positions, fit_shape)
+    parameters, converged = fit_gaussians(cutouts, fit_background)
+    fwhm = np.where(converged, GAUSSIAN_SIGMA_TO_FWHM * parameters[:, 3], np.nan)
+    return fwhm, origins[:, 0] + parameters[:, 1], origins[:, 1] + parameters[:, 2]
+
+
+def clipped_median_fwhm(fwhm, sigma=3.0, maxiters=5):
+    """Sigma-clipped median of the valid FWHMs, NaN if there are none."""
+    fwhm = np.asarray(fwhm)
+    fwhm = fwhm[np.isfinite(fwhm) & (fwhm > 0)]
+    if len(fwhm) == 0:
+        return np.nan
+    clipped = sigma_clip(fwhm, sigma=sigma, maxiters=maxiters)
+    return float(np.median(clipped.compressed()))
+
+
+def fwhm_grid(x, y, fwhm, shape, n_cells=4, min_stars=5):
+    """Clipped median FWHM in an n_cells x n_cells grid over an image of the given shape.
+
+    Returns (grid, y_centres, x_centres). Cells with fewer than min_stars measurements get the median of
+    the whole image.
+    """
+    good = np.isfinite(fwhm) & (fwhm > 0)
+    x, y, fwhm = np.asarray(x)[good], np.asarray(y)[good], np.asarray(fwhm)[good]
+    overall = clipped_median_fwhm(fwhm)
+    column = np.clip((x / shape[1] * n_cells).astype(int), 0, n_cells - 1)
+    row = np.clip((y / shape[0] * n_cells).astype(int), 0, n_cells - 1)
+    grid = np.full((n_cells, n_cells), overall)
+    for i in range(n_cells):
+        for j in range(n_cells):
+            in_cell = (row == i) & (column == j)
+            if in_cell.sum() >= min_stars:
+                grid[i, j] = clipped_median_fwhm(fwhm[in_cell])
+    y_centres = (np.arange(n_cells) + 0.5) * shape[0] / n_cells
+    x_centres = (np.arange(n_cells) + 0.5) * shape[1] / n_cells
+    return grid, y_centres, x_centres
+
+
+def interpolate_fwhm(grid, y_centres, x_centres, x, y):
+    """FWHM at the points (x, y), bilinear between the grid cell centres and flat beyond the outer ones."""
+    interpolator = RegularGridInterpolator((y_centres, x_centres), grid)
+    points = np.column_stack((np.clip(y, y_centres[0], y_centres[-1]), np.clip(x, x_centres[0], x_centres[-1])))
+    return interpolator(points)
+
+
+def fwhm_map(grid, y_centres, x_centres, shape):
+    """Full-resolution FWHM map of an image of the given shape from a fwhm_grid()."""
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return interpolate_fwhm(grid, y_centres, x_centres, x.ravel(), y.ravel()).reshape(shape).astype(np.float32)
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from Synthetic_Data import write_night
+from Main import trim_fits_data, read_trimmed_fits_file, load_and_trim_fits_files
+from Frame_Catalogue import open_frame
+from Bias_Master import process_bias
+from Flat_Master_Normalised_flat_Creator_OD import process_flats_and_save
+from Data_Reduction import as_float32_master, calibrate_frames
+from NewAperturePhotometry import run_photometry
+
+# Benchmarks of every pipeline stage on a deterministic synthetic night (see Synthetic_Data.py), so the
+# numbers can be reproduced on any Linux machine without the observation data:
+#   python Benchmark.py --size 2048 --science 5 --output benchmark.json
+# Every case runs in its own process, so the peak RSS reported for a case belongs to that case only.
+# Cases run in order and later ones read what earlier ones wrote (master bias -> flats -> reduced frames).
+
+BANDS = ['B-band', 'U-band', 'V-band']
+
+
+def fits_files(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.fits'))
+
+def pixel_bytes(frames):
+    return int(sum(frame.size * frame.dtype.itemsize for frame in frames))
+
+
+# --- Cases ---
+# Each case takes (data_dir, work_dir, options) and returns (frames processed, bytes of pixel data read)
+
+def bench_trim(data_dir, work_dir, options):
+    # Read + trim_fits_data of every bias and science frame, the per-file ingest cost
+    paths = fits_files(os.path.join(data_dir, 'Calibration', 'Bias'))
+    for band in BANDS:
+        paths += fits_files(os.path.join(data_dir, 'M52', band))
+    n_bytes = 0
+    for path in paths:
+        n_bytes += read_trimmed_fits_file(path).nbytes
+    return len(paths), n_bytes
+
+def bench_bias(data_dir, work_dir, options):
+    bias = load_and_trim_fits_files(os.path.join(data_dir, 'Calibration', 'Bias'), report=False)
+    process_bias(bias, show_plot=False, save_path=os.path.join(work_dir, 'master_bias.fits'), method=options.method)
+    return len(bias), pixel_bytes(bias)
+
+def bench_flats(data_dir, work_dir, options):
+    master_bias = fits.getdata(os.path.join(work_dir, 'master_bias.fits'))
+    n_frames = n_bytes = 0
+    for band in BANDS:
+        flats = load_and_trim_fits_files(os.path.join(data_dir, 'Calibration', 'Flats', band.replace('band', 'Band')),
+                                         report=False)
+        process_flats_and_save(flats, os.path.join(work_dir, f'master_flat_{band}.fits'), master_bias, method=options.method)
+        n_frames += len(flats)
+        n_bytes += pixel_bytes(flats)
+    return n_frames, n_bytes
+
+def bench_calibration(data_dir, work_dir, options):
+    # The Data_Reduction loop: trim, (raw - bias) / flat into one reused buffer, write the reduced frame
+    master_bias = as_float32_master('bias', fits.getdata(os.path.join(work_dir, 'master_bias.fits')))
+    n_frames = n_bytes = 0
+    for band in BANDS:
+        master_flat = as_float32_master(band, fits.getdata(os.path.join(work_dir, f'master_flat_{band}.fits')))
+        paths = fits_files(os.path.join(data_dir, 'M52', band))
+        frames = [trim_fits_data(open_frame(path)[0]) for path in paths]
+        output_dir = os.path.join(work_dir, 'reduced', band)
+        os.makedirs(output_dir, exist_ok=True)
+        for path, reduced in zip(paths, calibrate_frames(frames, master_bias, master_flat)):
+            fits.writeto(os.path.join(output_dir, os.path.basename(path)), reduced, overwrite=True)
+        n_frames += len(frames)
+        n_bytes += pixel_bytes(frames)
+    return n_frames, n_bytes
+
+def bench_photometry(data_dir, work_dir, options):
+    image_paths = []
+    for band in BANDS:
+        paths = fits_files(os.path.join(work_dir, 'reduced', band))[:options.photometry_images]
+        image_paths += [(path, f'M52_{band[0]}_{i}') for i, path in enumerate(paths)]
+    results, timings = run_photometry(image_paths, workers=options.workers)
+    n_bytes = sum(os.path.getsize(path) for path, _ in image_paths)
+    return len(image_paths), n_bytes
+
+
+CASES = {
+    'trim_fits_data': bench_trim,
+    'process_bias': bench_bias,
+    'process_flats_and_save': bench_flats,
+    'calibration': bench_calibration,
+    'photometry': bench_photometry,
+}
+
+
+def run_case(name, data_dir, work_dir, options, queue):
+    start = time.perf_counter()
+    n_frames, n_bytes = CASES[name](data_dir, work_dir, options)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((name, seconds, n_frames, n_bytes, peak_rss))
+
+
+def run_benchmarks(options, cases=None):
+    """Generate the synthetic night and run the cases, returning a Table with one row per case."""
+    work_dir = options.workdir or tempfile.mkdtemp(prefix='tgp_benchmark_')
+    data_dir = os.path.join(work_dir, 'observation_data')
+    start = time.perf_counter()
+    write_night(data_dir, (options.size, options.size), options.bias, options.flats, options.science,
+                options.density, options.fwhm, seed=options.seed)
+    print(f"Synthetic night written to {data_dir} in {time.perf_counter() - start:.1f} s")
+
+    results = Table(names=('case', 'seconds', 'frames', 'frames_per_s', 'MB_per_s', 'peak_rss_MB'),
+                    dtype=('U32', 'f8', 'i8', 'f8', 'f8', 'f8'))
+    context = multiprocessing.get_context('spawn')  # a fresh interpreter per case, so peak RSS is per case
+    queue = context.Queue()
+    try:
+        for name in cases or list(CASES):
+            process = context.Process(target=run_case, args=(name, data_dir, work_dir, options, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"Benchmark case {name} failed (exit code {process.exitcode})")
+                continue
+            name, seconds, n_frames, n_bytes, peak_rss = queue.get()
+            results.add_row((name, seconds, n_frames, n_frames / seconds, n_bytes / 1024**2 / seconds, peak_rss))
+    finally:
+        if not options.keep and not options.workdir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    for column in ['seconds', 'frames_per_s', 'MB_per_s', 'peak_rss_MB']:
+        results[column].format = '.2f'
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic data")
+    parser.add_argument('cases', nargs='*', metavar='case', help=f"cases to run, from {', '.join(CASES)}; default is all")
+    parser.add_argument('--size', type=int, default=2048, help="frame size in pixels (the detector is 4096)")
+    parser.add_argument('--bias', type=int, default=10, help="number of bias frames")
+    parser.add_argument('--flats', type=int, default=5, help="number of flats per band")
+    parser.add_argument('--science', type=int, default=5, help="number of science frames per band")
+    parser.add_argument('--density', type=float, default=200.0, help="stars per million pixels")
+    parser.add_argument('--fwhm', type=float, default=4.0, help="PSF FWHM in pixels")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--method', default='mean', help="combine method for the bias and flats")
+    parser.add_argument('--photometry-images', type=int, default=1, help="reduced frames per band to measure")
+    parser.add_argument('--workers', type=int, default=1, help="photometry worker processes")
+    parser.add_argument('--workdir', default=None, help="where to write the synthetic data (kept afterwards)")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary synthetic data")
+    parser.add_argument('--output', default=None, help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s) {', '.join(unknown)}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmarks(args, args.cases)
+    print(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': vars(args), 'python': sys.version, 'numpy': np.__version__,
+                       'results': [dict(zip(results.colnames, [row[c].item() for c in results.colnames]))
+                                   for row in results]}, f, indent=1)
+        print(f"Results written to {args.output}")
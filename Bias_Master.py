@@ -1,30 +1,49 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from astropy.io import fits
-from Main import Bias  # Importing Bias from Main.py
-from matplotlib import colors
-import os
-
-def process_bias(bias_files, show_plot=True, save_path=None):
-    master_bias = np.mean(bias_files, axis=0)
-
-    if show_plot:
-        plt.imshow(master_bias, cmap='hot', origin='lower', norm=colors.LogNorm(vmin=np.percentile(master_bias, 5), vmax=np.percentile(master_bias, 95)))
-        plt.colorbar(format='%.2f')
-        plt.title("Master Bias Frame")
-        plt.show()
-
-    # Save the master bias
-    if save_path:
-        os.makedirs(os.path.dirname(save_path), exist_ok=True) # Ensure the folder exists
-        hdu = fits.PrimaryHDU(master_bias)
-        hdu.writeto(save_path, overwrite=True)
-        print(f"Master bias frame saved to {save_path}")
-    
-    return master_bias
-
-save_folder = 'G:/MyProject/TGP/data_reduction/Master_Bias'
-save_filename = 'master_bias.fits'
-save_path = os.path.join(save_folder, save_filename)
-
-master_bias = process_bias(Bias, show_plot=True, save_path=save_path)
+import numpy as np
+import matplotlib.pyplot as plt
+from astropy.io import fits
+from Main import catalogue, master_bias_path
+from Calibration_Cache import calibration_key, cache_header, load_cached_master
+from Frame_Combine import combine_frames, DEFAULT_MAX_MEMORY
+from Metrics import timer, count_bytes
+from matplotlib import colors
+import os
+
+def process_bias(bias_files, show_plot=True, save_path=None, method='mean', dtype=np.float64, max_memory=DEFAULT_MAX_MEMORY, workers=1, backend='thread', header=None):
+    # Streams over row tiles instead of np.mean(bias_files, axis=0), which first stacks every frame into one 3-D array.
+    # method can be 'mean', 'median', 'sigma_clip' or 'minmax'; dtype is the accumulator (float32 halves the working memory)
+    # workers > 1 combines the tiles on a thread/process pool (None uses every core)
+    with timer('bias.combine'):
+        master_bias = combine_frames(bias_files, method=method, dtype=dtype, max_memory=max_memory, workers=workers, backend=backend)
+    count_bytes('bias.combine', sum(frame.nbytes for frame in bias_files))
+
+    if show_plot:
+        plt.imshow(master_bias, cmap='hot', origin='lower', norm=colors.LogNorm(vmin=np.percentile(master_bias, 5), vmax=np.percentile(master_bias, 95)))
+        plt.colorbar(format='%.2f')
+        plt.title("Master Bias Frame")
+        plt.show()
+
+    # Save the master bias
+    if save_path:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True) # Ensure the folder exists
+        with timer('bias.write'):
+            hdu = fits.PrimaryHDU(master_bias, header=header)  # header carries the calibration cache key, if any
+            hdu.writeto(save_path, overwrite=True)
+        count_bytes('bias.write', master_bias.nbytes)
+        print(f"Master bias frame saved to {save_path}")
+    
+    return master_bias
+
+# Only rebuild the master bias when the bias files or the combine parameters have changed
+def build_master_bias(save_path=master_bias_path, method='mean', dtype=np.float64, show_plot=True, content_hash=False):
+    bias_paths = [frame.path for frame in catalogue.select('Bias')]
+    key = calibration_key(bias_paths, {'method': method, 'dtype': np.dtype(dtype).name}, content_hash)
+    master_bias = load_cached_master(save_path, key)
+    if master_bias is None:
+        header = cache_header(key, bias_paths, content_hash)
+        # The frames are only loaded here, so importing process_bias never scans the bias folder
+        master_bias = process_bias(catalogue.load_all('Bias'), show_plot=show_plot, save_path=save_path, method=method, dtype=dtype, header=header)
+    return master_bias
+
+# The guard keeps worker processes (and other scripts importing process_bias) from re-running the combine
+if __name__ == "__main__":
+    master_bias = build_master_bias()
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+from astropy.io import fits
+
+# Content-keyed cache for the master calibration frames. A master is only rebuilt when the set of
+# input files (path, size, mtime, or optionally their content) or the combine parameters change.
+# The key is written into the master's FITS header so later stages can check it from the header alone.
+
+CACHE_KEYWORD = 'CALKEY'     # inputs + combine parameters, decides whether the master is rebuilt
+INPUTS_KEYWORD = 'CALINKEY'  # inputs only, lets downstream stages check a master without knowing its parameters
+HASH_KEYWORD = 'CALHASH'     # whether the keys were built from file contents rather than size/mtime
+NFRAMES_KEYWORD = 'NCOMBINE'
+
+
+def file_signature(path, content_hash=False):
+    """What identifies one input file: path, size and mtime, or a SHA-1 of its bytes with content_hash."""
+    stat = os.stat(path)
+    if not content_hash:
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return [os.path.abspath(path), stat.st_size, sha1.hexdigest()]
+
+
+def inputs_key(paths, content_hash=False):
+    """Key of a set of input files, independent of the order they are given in."""
+    signatures = sorted(file_signature(path, content_hash) for path in paths)
+    return hashlib.sha1(json.dumps(signatures).encode()).hexdigest()
+
+
+def calibration_key(paths, params=None, content_hash=False, depends_on=None):
+    """Cache key of a master frame: its inputs, its combine parameters and the keys of the masters it uses."""
+    payload = {
+        'inputs': inputs_key(paths, content_hash),
+        'params': params or {},
+        'depends_on': depends_on or [],
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_cache_key(path, keyword=CACHE_KEYWORD):
+    """Cache key stored in a master frame's header (only the header is read), or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return fits.getheader(path).get(keyword)
+    except Exception as e:
+        print(f"Error reading header of {path}: {e}")
+        return None
+
+
+def load_cached_master(path, key):
+    """Data of the master at path if it was built with this key, otherwise None (it has to be rebuilt)."""
+    if read_cache_key(path) != key:
+        return None
+    print(f"Master frame {path} is up to date, skipping rebuild.")
+    return fits.getdata(path)
+
+
+def cache_header(key, paths, content_hash=False, header=None):
+    """Header carrying the cache keys of a master built from paths."""
+    header = fits.Header() if header is None else header
+    header[CACHE_KEYWORD] = (key, 'Cache key: inputs+params')
+    header[INPUTS_KEYWORD] = (inputs_key(paths, content_hash), 'Cache key: inputs only')
+    header[HASH_KEYWORD] = (bool(content_hash), 'Cache keys use file contents')
+    header[NFRAMES_KEYWORD] = (len(paths), 'Number of frames combined')
+    return header
+
+
+def is_master_current(path, paths):
+    """Cheap check that the master at path was built from exactly these input files."""
+    if not os.path.exists(path):
+        return False
+    header = fits.getheader(path)
+    stored = header.get(INPUTS_KEYWORD)
+    if stored is None:
+        return False
+    return stored == inputs_key(paths, header.get(HASH_KEYWORD, False))
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.table import Table, MaskedColumn
+
+# Cross-band matching of the photometry of one field into a single U/B/V catalogue for colour-magnitude
+# diagrams. Each band's stack is aligned on its own first frame, so the stacks of one object are offset
+# from each other by the pointing differences between the bands: the offset of every band's stack relative
+# to the reference band's stack is measured with the same FrameAligner as the stacking (phase correlation
+# refined by star centroids, cached), and the source positions are moved into the reference band's pixel
+# frame before matching.
+#
+# Matching builds a KD-tree on the positions collected so far and queries all of a band's sources at once,
+# so it is O(N log N): 100k sources per band match in well under a second. Every source is matched to its
+# nearest neighbour within max_separation pixels, one-to-one (when two sources claim the same neighbour
+# the closer one wins); sources without a match start rows of their own, so a star seen in one band only
+# is kept with the other bands masked.
+
+REFERENCE_BAND = 'V'
+
+
+def band_offsets(band_images, reference_band=REFERENCE_BAND, aligner=None):
+    """(dx, dy) of every band's stacked image relative to the reference band's, from {band: image path}.
+
+    A star at (x, y) in the reference stack is at (x + dx, y + dy) in the band's stack.
+    """
+    from Align_Stack import FrameAligner
+    aligner = aligner or FrameAligner()
+    reference_path = band_images[reference_band]
+    offsets = {band: aligner.transform(path, reference_path) for band, path in band_images.items()}
+    aligner.save_cache()
+    return offsets
+
+
+def match_positions(reference_x, reference_y, x, y, max_separation=2.0):
+    """Index into the reference positions of the nearest match of every (x, y), -1 where there is none.
+
+    Matches are one-to-one: of several positions with the same nearest reference, only the closest keeps it.
+    """
+    matches = np.full(len(x), -1, dtype=np.int64)
+    if len(reference_x) == 0 or len(x) == 0:
+        return matches
+    tree = cKDTree(np.column_stack((reference_x, reference_y)))
+    distance, index = tree.query(np.column_stack((x, y)), k=1, distance_upper_bound=max_separation)
+    found = np.flatnonzero(np.isfinite(distance))
+    # Closest first, then keep the first claim on every reference source
+    found = found[np.argsort(distance[found], kind='stable')]
+    _, first = np.unique(index[found], return_index=True)
+    winners = found[first]
+    matches[winners] = index[winners]
+    return matches
+
+
+def magnitude_column(table):
+    """The magnitude column of a photometry table: the aperture-corrected total_mag when there is one, else
+    instrumental_mag. The standard-star calibration uses the same choice, so its zero points fit these."""
+    return 'total_mag' if 'total_mag' in table.colnames else 'instrumental_mag'
+
+
+def match_bands(tables, offsets=None, reference_band=REFERENCE_BAND, max_separation=2.0):
+    """Merge {band: photometry table} into one table with a row per star.
+
+    offsets ({band: (dx, dy)}, see band_offsets) move every band into the reference band's pixel frame.
+    The result has x, y (reference frame, averaged over the bands the star was found in), n_bands and for
+    every band id_<band>, mag_<band> and err_<band>, masked where the star wasn't found, plus the B-V and
+    U-B colours when those bands are present.
+    """
+    offsets = offsets or {}
+    bands = sorted(tables, key=lambda band: (band != reference_band, band))  # reference band first
+
+    sum_x = np.empty(0)
+    sum_y = np.empty(0)
+    n_found = np.empty(0, dtype=np.int64)
+    rows = {}  # band -> row of the merged table of each of its sources
+    for band in bands:
+        table = tables[band]
+        dx, dy = offsets.get(band, (0.0, 0.0))
+        x = np.asarray(table['xcenter'], dtype=float) - dx
+        y = np.asarray(table['ycenter'], dtype=float) - dy
+        # Match against the mean position of every star collected so far
+        seen = np.maximum(n_found, 1)
+        band_rows = match_positions(sum_x / seen, sum_y / seen, x, y, max_separation)
+        new = band_rows < 0
+        band_rows[new] = len(sum_x) + np.arange(new.sum())
+        sum_x = np.concatenate((sum_x, np.zeros(new.sum())))
+        sum_y = np.concatenate((sum_y, np.zeros(new.sum())))
+        n_found = np.concatenate((n_found, np.zeros(new.sum(), dtype=np.int64)))
+        np.add.at(sum_x, band_rows, x)
+        np.add.at(sum_y, band_rows, y)
+        np.add.at(n_found, band_rows, 1)
+        rows[band] = band_rows
+
+    n_rows = len(sum_x)
+    merged = Table()
+    merged['x'] = sum_x / np.maximum(n_found, 1)
+    merged['y'] = sum_y / np.maximum(n_found, 1)
+    merged['n_bands'] = n_found
+    for band in bands:
+        table = tables[band]
+        band_rows = rows[band]
+        for name, column, dtype in [(f'id_{band}', 'id', np.int64), (f'mag_{band}', magnitude_column(table), float),
+                                    (f'err_{band}', 'mag_error', float)]:
+            values = np.zeros(n_rows, dtype=dtype)
+            mask = np.ones(n_rows, dtype=bool)
+            values[band_rows] = np.asarray(table[column], dtype=dtype)
+            mask[band_rows] = False
+            merged[name] = MaskedColumn(values, mask=mask)
+
+    for blue, red in [('B', 'V'), ('U', 'B')]:
+        if blue in tables and red in tables:
+            merged[f'{blue}-{red}'] = merged[f'mag_{blue}'] - merged[f'mag_{red}']
+    merged.meta['REFBAND'] = reference_band
+    merged.meta['MAXSEP'] = max_separation
+    for band, (dx, dy) in offsets.items():
+        merged.meta[f'DX_{band}'] = dx
+        merged.meta[f'DY_{band}'] = dy
+    # Airmass of every band's image and the column its magnitudes came from, for Standard_Calibration.py
+    for band in bands:
+        merged.meta[f'MAGCOL_{band}'] = magnitude_column(tables[band])
+        if 'airmass' in tables[band].meta:
+            merged.meta[f'AIRM_{band}'] = tables[band].meta['airmass']
+    return merged
+
+
+def match_object(catalogue, obj_name, band_images=None, reference_band=REFERENCE_BAND, max_separation=2.0,
+                 aligner=None):
+    """Merged table of obj_name's bands from a PhotometryCatalogue.
+
+    band_images ({band: stacked image path}) gives the images to measure the band offsets on; without it
+    the bands are assumed to be registered already.
+    """
+    tables = {}
+    for band in ['U', 'B', 'V']:
+        table = catalogue.read(obj_name=obj_name, band=band, with_label=False)
+        if len(table):
+            tables[band] = table
+    if reference_band not in tables:
+        print(f"No {reference_band}-band photometry of {obj_name}, nothing to match against.")
+        return None
+    offsets = None
+    if band_images:
+        band_images = {band: path for band, path in band_images.items() if band in tables and os.path.exists(path)}
+        if reference_band in band_images:
+            offsets = band_offsets(band_images, reference_band, aligner)
+    merged = match_bands(tables, offsets, reference_band, max_separation)
+    merged.meta['OBJECT'] = obj_name
+    print(f"{obj_name}: {len(merged)} stars, {np.sum(merged['n_bands'] == len(tables))} found in all {len(tables)} bands")
+    return merged
@@ -0,0 +1,52 @@
+import numpy as np
+from photutils.aperture import CircularAperture, aperture_photometry
+
+# Photometry through a list of aperture radii in one aperture_photometry call, and the curve of growth
+# built from it: which radius gives the best SNR for the image and the aperture correction from that
+# radius to the largest one.
+
+
+def multi_aperture_photometry(data, positions, radii, sky_median, sky_variance):
+    """Sky-subtracted flux and SNR of every source through every radius.
+
+    Returns (phot_table, net_flux, snr): the aperture_photometry table (id, xcenter, ycenter and one
+    aperture_sum column per radius) and (n_sources, n_radii) arrays. The SNR uses each source's own
+    sky variance: flux / sqrt(flux + area * sky_variance).
+    """
+    radii = np.atleast_1d(radii)
+    apertures = [CircularAperture(positions, r=r) for r in radii]
+    phot_table = aperture_photometry(data, apertures if len(radii) > 1 else apertures[0])
+
+    if len(radii) == 1:
+        sums = np.asarray(phot_table['aperture_sum'])[:, None]
+    else:
+        sums = np.column_stack([np.asarray(phot_table[f'aperture_sum_{k}']) for k in range(len(radii))])
+    areas = np.array([aperture.area for aperture in apertures])
+
+    net_flux = sums - np.asarray(sky_median)[:, None] * areas[None, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        snr = net_flux / np.sqrt(net_flux + areas[None, :] * np.asarray(sky_variance)[:, None])
+    return phot_table, net_flux, snr
+
+
+def curve_of_growth(net_flux, snr, n_bright=50):
+    """Median curve of growth of an image and the radius index with the best median SNR.
+
+    The growth curve is the median over the n_bright brightest stars of flux(r) / flux(r_max). Stars are
+    ranked on their flux in the smallest aperture, so faint detections next to a bright star (which only
+    look bright in the large apertures) don't end up in the sample.
+    Returns (growth, median_snr, best_index, aperture_correction), where aperture_correction is the
+    magnitude to add to a best-radius magnitude to get the r_max magnitude (0 for a single radius).
+    """
+    n_radii = net_flux.shape[1]
+    good = np.all(net_flux > 0, axis=1)
+    if n_radii == 1 or not good.any():
+        return np.ones(n_radii), np.nanmedian(snr, axis=0), n_radii - 1, 0.0
+
+    good_flux = net_flux[good]
+    bright = np.argsort(good_flux[:, 0])[::-1][:n_bright]
+    growth = np.median(good_flux[bright] / good_flux[bright][:, -1:], axis=0)
+    median_snr = np.median(snr[good], axis=0)
+    best_index = int(np.argmax(median_snr))
+    aperture_correction = 2.5 * np.log10(growth[best_index])
+    return growth, median_snr, best_index, aperture_correction
@@ -0,0 +1,76 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from astropy.io import fits
+from Main import catalogue, master_bias_path, master_dark_path
+from Calibration_Cache import CACHE_KEYWORD, calibration_key, cache_header, load_cached_master
+from Frame_Combine import combine_frames, DEFAULT_MAX_MEMORY
+from Metrics import timer, count_bytes
+import os
+
+# The master dark is the dark current in ADU per second: every dark has the master bias subtracted and is
+# divided by its EXPTIME inside the tile-wise combine (the same bounded-memory path as the master bias),
+# so darks of different lengths can be combined. Data_Reduction.py scales it back up by each science
+# frame's EXPTIME.
+
+def dark_exposure_times(dark_paths):
+    # EXPTIME of every dark, from the headers only
+    exposure_times = []
+    for path in dark_paths:
+        exptime = fits.getheader(path).get('EXPTIME')
+        if exptime is None or float(exptime) <= 0:
+            raise ValueError(f"Dark frame {path} has no positive EXPTIME, it can't be scaled to a dark rate")
+        exposure_times.append(float(exptime))
+    return exposure_times
+
+def process_dark(dark_files, exposure_times, master_bias, show_plot=True, save_path=None, method='sigma_clip', dtype=np.float64,
+                 max_memory=DEFAULT_MAX_MEMORY, workers=1, backend='thread', header=None):
+    # (dark - bias) / EXPTIME is applied tile by tile inside the combine. The default sigma-clipped mean rejects
+    # the cosmic rays that long darks collect; method can also be 'mean', 'median' or 'minmax'.
+    with timer('dark.combine'):
+        master_dark = combine_frames(dark_files, method=method, dtype=dtype, max_memory=max_memory, offset=master_bias,
+                                     scales=exposure_times, workers=workers, backend=backend)
+    count_bytes('dark.combine', sum(frame.nbytes for frame in dark_files))
+
+    if show_plot:
+        plt.imshow(master_dark, cmap='hot', origin='lower', vmin=np.percentile(master_dark, 5), vmax=np.percentile(master_dark, 95))
+        plt.colorbar(format='%.4f', label='ADU/s')
+        plt.title("Master Dark Frame (dark current)")
+        plt.show()
+
+    # Save the master dark
+    if save_path:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True) # Ensure the folder exists
+        header = fits.Header() if header is None else header
+        header['BUNIT'] = ('ADU/s', 'Dark current per second of exposure')
+        with timer('dark.write'):
+            hdu = fits.PrimaryHDU(master_dark, header=header)  # header carries the calibration cache key, if any
+            hdu.writeto(save_path, overwrite=True)
+        count_bytes('dark.write', master_dark.nbytes)
+        print(f"Master dark frame saved to {save_path}")
+
+    return master_dark
+
+# Only rebuild the master dark when the dark files, the combine parameters or the master bias have changed
+def build_master_dark(save_path=master_dark_path, method='sigma_clip', dtype=np.float64, show_plot=True, content_hash=False):
+    dark_frames = catalogue.select('Dark')
+    if not dark_frames:
+        print("No dark frames found, the reduction will run without dark correction.")
+        return None
+    dark_paths = [frame.path for frame in dark_frames]
+
+    with fits.open(master_bias_path) as hdul:
+        master_bias = hdul[0].data
+        bias_key = hdul[0].header.get(CACHE_KEYWORD)
+
+    key = calibration_key(dark_paths, {'method': method, 'dtype': np.dtype(dtype).name}, content_hash, depends_on=[bias_key])
+    master_dark = load_cached_master(save_path, key)
+    if master_dark is None:
+        header = cache_header(key, dark_paths, content_hash)
+        dark_files = [catalogue.load(frame) for frame in dark_frames]
+        master_dark = process_dark(dark_files, dark_exposure_times(dark_paths), master_bias, show_plot=show_plot,
+                                   save_path=save_path, method=method, dtype=dtype, header=header)
+    return master_dark
+
+# The guard keeps worker processes (and other scripts importing process_dark) from re-running the combine
+if __name__ == "__main__":
+    master_dark = build_master_dark()
@@ -2,20 +2,28 @@ import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
 import os
-import gc
 from matplotlib import colors
-from Main import m52, ngc7789, Standard_Star_1, Standard_Star_2  # Importing data from Main.py
+from Main import catalogue, reduction_dir, master_bias_path, master_dark_path, master_flat_path  # Importing the frame catalogue from Main.py
+from Frame_Catalogue import open_frame
+from Intermediate_Storage import write_frame
+from Calibration_Cache import is_master_current
+from Metrics import timer, count_bytes
 
-bias_master_dir = 'G:/MyProject/TGP/data_reduction/Master_Bias'
-master_flats_dir = 'G:/MyProject/TGP/data_reduction/Flats/Master'
-reduced_image_dir = 'G:/MyProject/TGP/data_reduction/Reduced Image'  # Directory where the processed (reduced) FITS files will be saved
+try:
+    import numexpr  # optional, only used by calibrate_frame(backend='numexpr')
+except ImportError:
+    numexpr = None
 
-if not os.path.exists(reduced_image_dir):
-    os.makedirs(reduced_image_dir)
+reduced_image_dir = os.path.join(reduction_dir, 'Reduced Image')  # Directory where the processed (reduced) FITS files will be saved
+
+def check_master(path, obj, band=None):
+    # Compares the input-file key in the master's header with the files on disk now (only headers and stat calls)
+    if not is_master_current(path, [frame.path for frame in catalogue.select(obj, band)]):
+        print(f"Warning: {path} was not built from the current {obj} frames (or has no cache key). Re-run the master script.")
 
 def load_master_bias():
-    master_bias_path = os.path.join(bias_master_dir, 'Master_Bias.fits')
     if os.path.exists(master_bias_path):
+        check_master(master_bias_path, 'Bias')
         with fits.open(master_bias_path) as hdul:
             master_bias = hdul[0].data
             return master_bias
@@ -23,80 +31,180 @@ def load_master_bias():
         print("Master bias file not found.")
         return None
 
-master_bias = load_master_bias()
-if master_bias is None:
-    raise FileNotFoundError("Master bias file could not be loaded. Please ensure it exists in the specified directory.")
+def load_master_dark():
+    # Optional: without a master dark the frames are only bias subtracted and flat fielded
+    if os.path.exists(master_dark_path):
+        check_master(master_dark_path, 'Dark')
+        with fits.open(master_dark_path) as hdul:
+            master_dark = hdul[0].data
+            return master_dark
+    else:
+        print("Master dark file not found, skipping dark correction.")
+        return None
 
 def load_master_flat(band):
-    master_flat_path = os.path.join(master_flats_dir, f'Master_Flat_{band}.fits')
-    if os.path.exists(master_flat_path):
-        with fits.open(master_flat_path) as hdul:
+    flat_path = master_flat_path(band)
+    if os.path.exists(flat_path):
+        check_master(flat_path, 'Flats', band)
+        with fits.open(flat_path) as hdul:
             master_flat = hdul[0].data
             return master_flat
     else:
         print(f"Master flat file for {band} not found.")
         return None
 
-# load the master flats into the dictionary for each available type from our image
-master_flats = {}
-filter_types = ['B-Band', 'U-Band', 'V-Band']
-for filter_type in filter_types:
-    master_flat = load_master_flat(filter_type)
+def load_master_flats():
+    # load the master flats into the dictionary for each available type from our image
+    master_flats = {}
+    filter_types = ['B-Band', 'U-Band', 'V-Band']
+    for filter_type in filter_types:
+        master_flat = load_master_flat(filter_type)
+        if master_flat is not None:
+            master_flats[filter_type] = master_flat
+    return master_flats
+
+# Master frames cast to float32 once and reused for every frame and band, keyed by (name, id of the source array)
+_float32_masters = {}
+
+def as_float32_master(name, master):
+    key = (name, id(master))
+    if key not in _float32_masters:
+        _float32_masters[key] = (master, np.ascontiguousarray(master, dtype=np.float32))  # keep master alive so its id stays unique
+    return _float32_masters[key][1]
+
+# bias + EXPTIME * dark rate for every exposure time seen so far, keyed by (id of bias, id of dark, exptime).
+# A night only has a handful of exposure times, so each offset frame is built once and reused.
+_dark_offsets = {}
+
+def calibration_offset(master_bias, master_dark=None, exptime=0.0):
+    # What calibrate_frame subtracts: the master bias, plus the dark current scaled to the exposure time
+    if master_dark is None or not exptime:
+        return master_bias
+    key = (id(master_bias), id(master_dark), float(exptime))
+    if key not in _dark_offsets:
+        offset = np.multiply(master_dark, np.float32(exptime), dtype=np.float32)
+        offset += master_bias
+        _dark_offsets[key] = (master_bias, master_dark, offset)  # keep the masters alive so their ids stay unique
+    return _dark_offsets[key][2]
+
+def calibrate_frame(raw, master_bias, master_flat=None, out=None, backend='numpy', master_dark=None, exptime=0.0):
+    # Fused calibration: out = (raw - bias - exptime * dark) / flat in one float32 buffer, without the intermediate
+    # frame lists. The bias and scaled dark are one cached offset frame (calibration_offset), so dark correction adds
+    # no extra pass over the frame. master_bias/master_dark/master_flat should already be float32 (see
+    # as_float32_master). backend='numexpr' evaluates the whole expression in one multithreaded pass when numexpr is installed.
+    master_bias = calibration_offset(master_bias, master_dark, exptime)
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float32)
+    if backend == 'numexpr' and numexpr is not None:
+        raw = np.asarray(raw)
+        if master_flat is None:
+            numexpr.evaluate('raw - bias', local_dict={'raw': raw, 'bias': master_bias}, out=out, casting='unsafe')
+        else:
+            numexpr.evaluate('(raw - bias) / flat', local_dict={'raw': raw, 'bias': master_bias, 'flat': master_flat},
+                             out=out, casting='unsafe')
+        return out
+    np.subtract(raw, master_bias, out=out, dtype=np.float32)
     if master_flat is not None:
-        master_flats[filter_type] = master_flat
-
-def subtract_bias(fits_data, master_bias):
-    master_bias = master_bias.astype(np.float32)  # Convert to float32 to reduce memory usage
-    result = [lights_data.astype(np.float32) - master_bias for lights_data in fits_data]
-    gc.collect()  # Force garbage collection to free memory
-    return result
-    
-def divide_flat(fits_data, master_flat):
-    master_flat = master_flat.astype(np.float32)
-    result = [lights_data.astype(np.float32) / master_flat for lights_data in fits_data]
-    gc.collect()
-    return result
-
-#dictionary to store the imported FITS data from Main.py
-fits_data = {
-    'M52': m52,
-    'NGC7789': ngc7789,
-    'Standard Star 1': Standard_Star_1,
-    'Standard Star 2': Standard_Star_2
+        np.divide(out, master_flat, out=out)
+    return out
+
+def calibrate_frames(frames, master_bias, master_flat=None, backend='numpy', master_dark=None, exptimes=None):
+    # Yields each calibrated frame in the same preallocated float32 buffer. The buffer is overwritten by the
+    # next frame, so save (or copy) it before asking for the next one. exptimes (one per frame) scale master_dark.
+    out = None
+    for i, raw in enumerate(frames):
+        if out is None or out.shape != raw.shape:
+            out = np.empty(raw.shape, dtype=np.float32)
+        exptime = exptimes[i] if exptimes is not None else 0.0
+        yield calibrate_frame(raw, master_bias, master_flat, out=out, backend=backend, master_dark=master_dark, exptime=exptime)
+
+# Map the correct master flat for each band
+flat_bands_map = {
+    'B-band': 'B-Band',
+    'U-band': 'U-Band',
+    'V-band': 'V-Band'
 }
 
-# subtract master bias and divide by its respective master flat for each band and object
-for obj_name in ['M52', 'NGC7789', 'Standard Star 1', 'Standard Star 2']:
-    for band in ['B-band', 'U-band', 'V-band']:
-        # Check if FITS data exists for the current band
-        if band in fits_data[obj_name] and fits_data[obj_name][band]:
-            # Subtract master bias
-            fits_data[obj_name][band] = subtract_bias(fits_data[obj_name][band], master_bias)
-
-            # Map the correct master flat for each band
-            flat_bands_map = {
-                'B-band': 'B-Band',
-                'U-band': 'U-Band',
-                'V-band': 'V-Band'
-            }
+# Raw header keywords that no longer describe the reduced (trimmed, float32) frame
+_STALE_KEYWORDS = ['BZERO', 'BSCALE', 'BLANK', 'TRIMSEC', 'DATASEC', 'BIASSEC']
+
+def reduced_header(raw_header, dark_corrected=False):
+    # Keep the raw frame's header (EXPTIME, AIRMASS, DATE-OBS, FILTER, ...) for the alignment and calibration stages
+    header = raw_header.copy()
+    for keyword in _STALE_KEYWORDS:
+        header.remove(keyword, ignore_missing=True)
+    if dark_corrected:
+        header['HISTORY'] = 'Bias and dark subtracted and flat fielded by Data_Reduction.py'
+    else:
+        header['HISTORY'] = 'Bias subtracted and flat fielded by Data_Reduction.py'
+    return header
+
+def header_exptime(header):
+    try:
+        return float(header.get('EXPTIME', 0.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def reduced_frame_dir(obj_name, band, observation=None):
+    # Standard-star frames keep their First/Second/Third observation folder so they can be stacked per observation
+    parts = [reduced_image_dir, obj_name, band] + ([observation] if observation else [])
+    return os.path.join(*parts)
+
+def reduce_fits_data(master_bias, master_flats, backend='numpy', objects=('M52', 'NGC7789', 'Standard Star 1', 'Standard Star 2'),
+                     storage='fits', master_dark=None, **storage_options):
+    # subtract master bias and divide by its respective master flat for each band and object. Frames are read one at
+    # a time from the catalogue and written to disk as soon as they are calibrated, with the raw header.
+    # storage picks the file format of the reduced frames: 'fits' (float32), 'rice'/'hcompress' (tile-compressed)
+    # or 'npy' (float32/float16); storage_options go to Intermediate_Storage.write_frame.
+    # With master_dark (dark current per second) each frame also has EXPTIME * dark subtracted.
+    master_bias = as_float32_master('bias', master_bias)
+    if master_dark is not None:
+        master_dark = as_float32_master('dark', master_dark)
+    for obj_name in objects:
+        for band in ['B-band', 'U-band', 'V-band']:
+            # Check if FITS data exists for the current band
+            frames = catalogue.select(obj_name, band)
+            if not frames:
+                continue
 
             if flat_bands_map[band] in master_flats:
-                fits_data[obj_name][band] = divide_flat(fits_data[obj_name][band], master_flats[flat_bands_map[band]])
-                print(f"Divided {obj_name} {band} by {flat_bands_map[band]} master flat.")
+                master_flat = as_float32_master(flat_bands_map[band], master_flats[flat_bands_map[band]])
+                print(f"Dividing {obj_name} {band} by {flat_bands_map[band]} master flat.")
             else:
+                master_flat = None
                 print(f"Master flat {flat_bands_map[band]} not found for {band}, skipping flat-field correction.")
 
             # Save the processed data to the reduced image directory
-            for i, data in enumerate(fits_data[obj_name][band]):
-                reduced_image_filename = f"Reduced_Image_{obj_name}_{band.replace('-', '_')}_{i+1}.fits"
-                obj_band_dir = os.path.join(reduced_image_dir, obj_name, band)
+            out = None
+            for i, frame in enumerate(frames):
+                raw, raw_header = open_frame(frame.path, catalogue.trim_section, catalogue.use_header_section)
+                if out is None or out.shape != raw.shape:
+                    out = np.empty(raw.shape, dtype=np.float32)
+                # raw is memory-mapped, so this timer includes reading the pixels
+                with timer('reduce.calibrate'):
+                    data = calibrate_frame(raw, master_bias, master_flat, out=out, backend=backend,
+                                           master_dark=master_dark, exptime=header_exptime(raw_header))
+                count_bytes('reduce.calibrate', raw.nbytes)
+
+                obj_band_dir = reduced_frame_dir(obj_name, band, frame.observation)
                 if not os.path.exists(obj_band_dir):
                     os.makedirs(obj_band_dir)
+                reduced_image_filename = f"Reduced_Image_{obj_name}_{band.replace('-', '_')}_{i+1}.fits"
                 reduced_image_path = os.path.join(obj_band_dir, reduced_image_filename)
 
                 # write the reduced data to a FITS file
-                hdu = fits.PrimaryHDU(data)
-                hdu.writeto(reduced_image_path, overwrite=True)
-                print(f"Saved reduced image for {obj_name} {band} as {reduced_image_filename} in {obj_band_dir}.")
+                with timer('reduce.write'):
+                    reduced_image_path = write_frame(reduced_image_path, data, reduced_header(raw_header, master_dark is not None),
+                                                     storage=storage, **storage_options)
+                count_bytes('reduce.write', os.path.getsize(reduced_image_path))
+                print(f"Saved reduced image for {obj_name} {band} as {os.path.basename(reduced_image_path)} in {obj_band_dir}.")
+
+if __name__ == "__main__":
+    master_bias = load_master_bias()
+    if master_bias is None:
+        raise FileNotFoundError("Master bias file could not be loaded. Please ensure it exists in the specified directory.")
+    master_flats = load_master_flats()
+    master_dark = load_master_dark()
 
-print("Image reduction complete.")
+    reduce_fits_data(master_bias, master_flats, master_dark=master_dark)
+    print("Image reduction complete.")
@@ -4,35 +4,33 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 from astropy.io import fits
 from matplotlib import ticker
-from Main import Flats  # Import the Flats arrays from Main.py
+from Main import catalogue, flat_bands, master_bias_path, master_flat_path
+from Frame_Combine import combine_frames, frame_mean
+from Calibration_Cache import CACHE_KEYWORD, calibration_key, cache_header, load_cached_master
+from Metrics import timer, count_bytes
 
-master_bias_path = 'G:\\MyProject\\TGP\\data_reduction\\Master_Bias\\master_bias.fits'
-with fits.open(master_bias_path) as hdul:
-    master_bias = hdul[0].data
-    
-def subtract_bias(flat_data, master_bias):
-    return flat_data - master_bias
-
-def normalize_flat(flat_data):
-    mean_value = np.mean(flat_data)
+def flat_scale(flat_data, master_bias_mean):
+    # Mean of (flat - bias) without building the bias-subtracted frame: mean(flat) - mean(bias)
+    mean_value = frame_mean(flat_data) - master_bias_mean
     if mean_value == 0:
         print("Warning: Mean value of flat data is 0, normalization skipped.")
-        return flat_data  # Return the original data if the mean is 0 to avoid division by zero
-    normalized_flat = flat_data / mean_value
-    return normalized_flat
+        return 1.0
+    return mean_value
 
-def process_flats_and_save(flat_files, output_file, master_bias):
-    normalized_flats = []
-    for flat_data in flat_files:
-        flat_corrected = subtract_bias(flat_data, master_bias)
-        normalized_flat = normalize_flat(flat_corrected)
-        normalized_flats.append(normalized_flat)
-
-    if not normalized_flats:
+def process_flats_and_save(flat_files, output_file, master_bias, method='mean', workers=1, backend='thread', header=None):
+    if not flat_files:
         print("No valid flats were processed.")
         return None
 
-    master_flat = np.mean(normalized_flats, axis=0) 
+    # Bias subtraction and normalisation happen tile by tile inside the combine, so the normalised
+    # flats are never all held in memory. method can be 'mean', 'median', 'sigma_clip' or 'minmax'.
+    with timer('flats.scale'):
+        master_bias_mean = np.mean(master_bias)
+        scales = [flat_scale(flat_data, master_bias_mean) for flat_data in flat_files]
+    with timer('flats.combine'):
+        master_flat = combine_frames(flat_files, method=method, offset=master_bias, scales=scales,
+                                     workers=workers, backend=backend)
+    count_bytes('flats.combine', sum(flat_data.nbytes for flat_data in flat_files))
 
     # Save the master flat
     output_dir = os.path.dirname(output_file)
@@ -45,8 +43,11 @@ def process_flats_and_save(flat_files, output_file, master_bias):
             return
 
     try:
-        hdu = fits.PrimaryHDU(master_flat)
-        hdu.writeto(output_file, overwrite=True)
+        with timer('flats.write'):
+            # The normalised flat is ~1 everywhere, so float32 keeps ~7 significant digits at half the size of float64
+            hdu = fits.PrimaryHDU(master_flat.astype(np.float32), header=header)  # header carries the calibration cache key, if any
+            hdu.writeto(output_file, overwrite=True)
+        count_bytes('flats.write', hdu.data.nbytes)
         print(f"Master flat saved to: {output_file}")
     except Exception as e:
         print(f"Error saving file {output_file}: {e}")
@@ -66,12 +67,28 @@ def plot_master_flat(master_flat, title):
     else:
         print(f"No master flat to plot for {title}")
 
-def create_and_plot_master_flats():
-    output_base_dir = 'G:\\MyProject\\TGP\\data_reduction\\Flats\\Master'
-    for filter_name, flat_data in Flats.items():
-        output_path = os.path.join(output_base_dir, f'Master_Flat_{filter_name}.fits')
-        master_flat = process_flats_and_save(flat_data, output_path, master_bias)
-        plot_master_flat(master_flat, f'Master Flat for {filter_name} Band')      #Please uncomment the code to to run the plot. I put a comment on the code below because I don't want it to run when I run the script
+def create_and_plot_master_flats(method='mean', show_plot=True, content_hash=False):
+    with fits.open(master_bias_path) as hdul:
+        master_bias = hdul[0].data
+        bias_key = hdul[0].header.get(CACHE_KEYWORD)
+
+    master_flats = {}
+    for filter_name in flat_bands:
+        output_path = master_flat_path(filter_name)
+        # A master flat is only rebuilt when its flat files, the combine method or the master bias change
+        flat_paths = [frame.path for frame in catalogue.select('Flats', filter_name)]
+        key = calibration_key(flat_paths, {'method': method}, content_hash, depends_on=[bias_key])
+        master_flat = load_cached_master(output_path, key)
+        if master_flat is None:
+            header = cache_header(key, flat_paths, content_hash)
+            # The flats of a band are only loaded when its master has to be rebuilt
+            flat_data = catalogue.load_all('Flats', filter_name)
+            master_flat = process_flats_and_save(flat_data, output_path, master_bias, method=method, header=header)
+        if show_plot:
+            plot_master_flat(master_flat, f'Master Flat for {filter_name} Band')
+        master_flats[filter_name] = master_flat
+    return master_flats
 
 
-create_and_plot_master_flats()
+if __name__ == "__main__":
+    create_and_plot_master_flats()
@@ -0,0 +1,206 @@
+import os
+from collections import namedtuple
+import numpy as np
+from astropy.io import fits
+
+# Index of the observation_data tree (see README.MD for the layout). Only FITS headers are read when
+# the tree is indexed; pixels are memory-mapped and trimmed only when a stage asks for a frame.
+
+# Region kept after removing the overscan, as numpy (rows, columns) slices, per detector.
+# 'default' keeps rows 60:4050 and columns 0:4060 of the 4096x4096 frames.
+DETECTOR_TRIM_SECTIONS = {
+    'default': (slice(60, 4050), slice(0, 4060)),
+}
+DEFAULT_TRIM_SECTION = DETECTOR_TRIM_SECTIONS['default']
+
+# Header keywords that describe the useful part of the detector, in order of preference
+TRIM_KEYWORDS = ['TRIMSEC', 'DATASEC']
+
+# Folders that live under base_dir/Calibration instead of directly under base_dir
+CALIBRATION_FRAMES = ['Bias', 'Dark', 'Flats']
+
+Frame = namedtuple('Frame', ['object', 'band', 'observation', 'path', 'shape', 'dtype'])
+
+# BITPIX -> numpy dtype of the data as astropy hands it back (after BZERO/BSCALE)
+_BITPIX_DTYPES = {8: 'uint8', 16: 'int16', 32: 'int32', 64: 'int64', -32: 'float32', -64: 'float64'}
+_UNSIGNED_DTYPES = {16: ('uint16', 2**15), 32: ('uint32', 2**31), 64: ('uint64', 2**63)}
+
+
+def header_dtype(header):
+    """Work out the numpy dtype of the image data from the header alone."""
+    bitpix = header.get('BITPIX')
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bitpix in _UNSIGNED_DTYPES and bscale == 1 and bzero == _UNSIGNED_DTYPES[bitpix][1]:
+        return _UNSIGNED_DTYPES[bitpix][0]
+    if bscale != 1 or bzero != 0:
+        return 'float64' if bitpix in (32, 64, -64) else 'float32'
+    return _BITPIX_DTYPES.get(bitpix)
+
+
+def header_shape(header):
+    """Shape of the primary image as numpy sees it (rows, columns)."""
+    naxis = header.get('NAXIS', 0)
+    return tuple(header[f'NAXIS{i}'] for i in range(naxis, 0, -1))
+
+
+def parse_fits_section(section):
+    """Turn a FITS section string like '[1:4060,61:4050]' (1-based, inclusive, x first) into numpy slices."""
+    try:
+        x_range, y_range = section.strip().strip('[]').split(',')
+        x1, x2 = (int(value) for value in x_range.split(':'))
+        y1, y2 = (int(value) for value in y_range.split(':'))
+    except ValueError:
+        raise ValueError(f"Cannot parse FITS section '{section}'")
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    return (slice(y1 - 1, y2), slice(x1 - 1, x2))
+
+
+def trim_section_for(header=None, detector='default'):
+    """Trim region from the header (TRIMSEC/DATASEC) if one is given, otherwise the detector's default."""
+    if header is not None:
+        for keyword in TRIM_KEYWORDS:
+            if keyword in header:
+                return parse_fits_section(header[keyword])
+    if detector not in DETECTOR_TRIM_SECTIONS:
+        raise ValueError(f"Unknown detector '{detector}', expected one of {list(DETECTOR_TRIM_SECTIONS)}")
+    return DETECTOR_TRIM_SECTIONS[detector]
+
+
+def scale_data(raw, header, dtype):
+    """Apply BZERO/BSCALE to unscaled (raw) pixels."""
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return raw
+    bitpix = header.get('BITPIX')
+    if bitpix in _UNSIGNED_DTYPES and bscale == 1 and bzero == _UNSIGNED_DTYPES[bitpix][1]:
+        # Unsigned data stored with the usual offset: flipping the sign bit is the same as adding BZERO
+        unsigned = raw.view(raw.dtype.str.replace('i', 'u'))
+        return unsigned ^ unsigned.dtype.type(bzero)
+    return (raw * bscale + bzero).astype(dtype)
+
+
+class ScaledView:
+    """Trimmed view of a memory-mapped frame that still needs BZERO/BSCALE (e.g. unsigned 16-bit data).
+
+    astropy refuses to memory-map scaled images, so the raw pixels are mapped instead and only the part
+    that is sliced out (a row tile, a cutout, or the whole frame via np.asarray) is scaled into memory.
+    """
+    def __init__(self, raw, header, dtype):
+        self.raw = raw
+        self.header = header
+        self.dtype = np.dtype(dtype)
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.size = raw.size
+        self.nbytes = raw.size * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return scale_data(self.raw[key], self.header, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def astype(self, dtype):
+        return self[...].astype(dtype)
+
+
+def open_frame(path, trim_section=None, use_header_section=False):
+    """Header and memory-mapped (optionally trimmed) data of a FITS file, from a single open.
+
+    The trim is a plain slice of the memmap, so no pixels are copied. With use_header_section the
+    TRIMSEC/DATASEC keyword wins over trim_section when the file has one.
+    """
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        raw = hdul[0].data  # astropy keeps the memmap alive after the file is closed
+    if raw is None:
+        return None, header
+    if use_header_section:
+        trim_section = trim_section_for(header) if any(k in header for k in TRIM_KEYWORDS) else trim_section
+    view = raw if trim_section is None else raw[trim_section]
+    if header.get('BSCALE', 1) == 1 and header.get('BZERO', 0) == 0:
+        return view, header
+    return ScaledView(view, header, header_dtype(header)), header
+
+
+class FrameCatalogue:
+    def __init__(self, base_dir, detector='default', use_header_section=False):
+        self.base_dir = base_dir
+        self.trim_section = trim_section_for(detector=detector)
+        self.use_header_section = use_header_section  # trim with TRIMSEC/DATASEC when a frame has them
+        self._scanned = {}  # directory -> list of Frame, so every folder is only listed once
+
+    def frame_dir(self, obj, band=None, observation=None):
+        """Folder holding the frames of one object/band/observation."""
+        parts = [obj] + [part for part in (band, observation) if part]
+        if obj in CALIBRATION_FRAMES:
+            parts.insert(0, 'Calibration')
+        return os.path.join(self.base_dir, *parts)
+
+    def _scan(self, directory):
+        """Read the headers of every FITS file below directory (no pixel data)."""
+        if directory in self._scanned:
+            return self._scanned[directory]
+
+        frames = []
+        if not os.path.isdir(directory):
+            print(f"Directory not found: {directory}")
+        else:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                rel_parts = os.path.relpath(root, self.base_dir).split(os.sep)
+                if rel_parts[0] == 'Calibration':
+                    rel_parts = rel_parts[1:]
+                rel_parts += [None] * (3 - len(rel_parts))
+                obj, band, observation = rel_parts[:3]
+
+                for file_name in sorted(files):
+                    if not file_name.endswith('.fits'):
+                        continue
+                    file_path = os.path.join(root, file_name)
+                    try:
+                        header = fits.getheader(file_path)
+                    except Exception as e:
+                        print(f"Error reading header of {file_path}: {e}")
+                        continue
+                    frames.append(Frame(obj, band, observation, file_path,
+                                        header_shape(header), header_dtype(header)))
+
+        self._scanned[directory] = frames
+        return frames
+
+    def index(self):
+        """Index the whole base_dir tree and return every frame found."""
+        frames = []
+        for name in sorted(os.listdir(self.base_dir)):
+            if name == 'Calibration':
+                for cal in CALIBRATION_FRAMES:
+                    frames.extend(self.select(cal))
+            elif os.path.isdir(os.path.join(self.base_dir, name)):
+                frames.extend(self.select(name))
+        return frames
+
+    def select(self, obj, band=None, observation=None):
+        """Frames of one object, optionally narrowed to a band and an observation, in sorted path order."""
+        return list(self._scan(self.frame_dir(obj, band, observation)))
+
+    def load(self, frame):
+        """Memory-mapped, trimmed view of a single frame. Pixels are only read from disk when touched."""
+        data, header = open_frame(frame.path, self.trim_section, self.use_header_section)
+        return data
+
+    def iter_data(self, obj, band=None, observation=None):
+        """Yield trimmed views one frame at a time."""
+        for frame in self.select(obj, band, observation):
+            yield self.load(frame)
+
+    def load_all(self, obj, band=None, observation=None):
+        """List of trimmed, memory-mapped views for every frame of obj/band/observation."""
+        return list(self.iter_data(obj, band, observation))
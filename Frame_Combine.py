@@ -0,0 +1,292 @@
+import os
+import tempfile
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from astropy.stats import sigma_clipped_stats
+import Metrics
+from Metrics import timer, count_bytes
+
+# Shared, bounded-memory frame combining for bias, flat and science stacks. Frames are read one row
+# tile at a time (they can be plain arrays, memmaps or Frame_Catalogue views), so peak memory depends
+# on max_memory and not on how many frames go into the stack. Tiles can be combined on a thread or
+# process pool so large stacks use every core. Every tile is timed as 'combine.tile' (see Metrics.py), in
+# the worker process for the process backend, whose rows are merged back into the caller's report.
+
+COMBINE_METHODS = ['mean', 'median', 'sigma_clip', 'minmax']
+
+DEFAULT_MAX_MEMORY = 256 * 1024**2  # bytes of working memory, shared between all tiles in flight
+
+# Rough number of tile-sized temporaries each method needs on top of the stacked tile
+_WORKSPACE_FACTOR = {'mean': 2, 'median': 2, 'sigma_clip': 6, 'minmax': 2}
+
+# Each worker gets at least this many tiles so the pool stays busy
+_TILES_PER_WORKER = 4
+
+
+def tile_rows_for(method, n_frames, n_cols, dtype, max_memory=DEFAULT_MAX_MEMORY):
+    """Number of rows per tile that keeps the working set of one tile below max_memory."""
+    row_bytes = n_cols * np.dtype(dtype).itemsize * _WORKSPACE_FACTOR[method]
+    if method != 'mean':
+        row_bytes *= n_frames  # these methods need every frame's value for a pixel at once
+    return max(1, int(max_memory // row_bytes))
+
+
+def row_tiles(n_rows, tile_rows):
+    for start in range(0, n_rows, tile_rows):
+        yield slice(start, min(start + tile_rows, n_rows))
+
+
+def frame_mean(frame, tile_rows=256):
+    """Mean of a whole frame, read tile by tile so memmapped frames are never copied in full."""
+    total = 0.0
+    for rows in row_tiles(frame.shape[0], tile_rows):
+        total += np.sum(frame[rows], dtype=np.float64)
+    return total / (frame.shape[0] * frame.shape[1])
+
+
+def frame_tile(frames, i, rows, dtype, offset=None, scales=None):
+    """Rows of frame i as dtype, with the optional offset subtracted and scale divided out."""
+    tile = np.array(frames[i][rows], dtype=dtype)
+    if offset is not None:
+        tile -= offset[rows]
+    if scales is not None:
+        tile /= scales[i]
+    return tile
+
+
+def running_mean_tile(frames, rows, dtype, offset=None, scales=None):
+    # Running mean, one frame at a time: mean += (x - mean) / k. This stays accurate in float32,
+    # where summing a few hundred 16-bit frames first would lose the fractional part.
+    mean = frame_tile(frames, 0, rows, dtype, offset, scales)
+    for k in range(2, len(frames) + 1):
+        delta = frame_tile(frames, k - 1, rows, dtype, offset, scales)
+        delta -= mean
+        delta /= k
+        mean += delta
+    return mean
+
+
+def stacked_tile(frames, rows, dtype, offset=None, scales=None):
+    """(n_frames, rows, columns) block holding one row tile of every frame."""
+    first = frame_tile(frames, 0, rows, dtype, offset, scales)
+    stack = np.empty((len(frames),) + first.shape, dtype=dtype)
+    stack[0] = first
+    for i in range(1, len(frames)):
+        stack[i] = frame_tile(frames, i, rows, dtype, offset, scales)
+    return stack
+
+
+def reduce_stack(stack, method, sigma=3.0, maxiters=5, n_low=1, n_high=1, ignore_nan=False):
+    """Collapse a (n_frames, rows, columns) stack along the frame axis. The stack may be modified.
+
+    With ignore_nan, NaN values (e.g. where a shifted frame doesn't cover the pixel) are left out and a
+    pixel is only NaN when no frame covers it.
+    """
+    if ignore_nan:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN pixels
+            return _reduce_stack_ignoring_nan(stack, method, sigma, maxiters, n_low, n_high)
+    if method == 'mean':
+        return stack.mean(axis=0)
+    if method == 'median':
+        return np.median(stack, axis=0, overwrite_input=True)
+    if method == 'sigma_clip':
+        clipped_mean, _, _ = sigma_clipped_stats(stack, sigma=sigma, maxiters=maxiters, axis=0)
+        return clipped_mean
+    # minmax: drop the n_low lowest and n_high highest values of every pixel, then average the rest
+    n_frames = stack.shape[0]
+    stack.sort(axis=0)
+    return stack[n_low:n_frames - n_high].mean(axis=0)
+
+
+def _reduce_stack_ignoring_nan(stack, method, sigma, maxiters, n_low, n_high):
+    valid = np.isfinite(stack)
+    if method == 'mean':
+        return np.nanmean(stack, axis=0)
+    if method == 'median':
+        return np.nanmedian(stack, axis=0, overwrite_input=True)
+    if method == 'sigma_clip':
+        clipped_mean, _, _ = sigma_clipped_stats(stack, mask=~valid, sigma=sigma, maxiters=maxiters, axis=0)
+        return clipped_mean
+    # minmax: sorting puts the NaNs last, so the rejected values are counted among each pixel's valid ones.
+    # A pixel covered by too few frames to reject any keeps the plain mean of those it has.
+    n_valid = valid.sum(axis=0)
+    stack.sort(axis=0)
+    index = np.arange(stack.shape[0])[:, None, None]
+    keep = (index >= n_low) & (index < n_valid - n_high)
+    n_kept = keep.sum(axis=0)
+    return np.where(n_kept > 0, np.where(keep, stack, 0).sum(axis=0) / n_kept, np.nanmean(stack, axis=0))
+
+
+def combine_tile(frames, rows, method, dtype, offset=None, scales=None, **options):
+    with timer('combine.tile'):
+        if method == 'mean' and not options.get('ignore_nan'):
+            combined = running_mean_tile(frames, rows, dtype, offset, scales)
+        else:
+            combined = reduce_stack(stacked_tile(frames, rows, dtype, offset, scales), method, **options)
+    count_bytes('combine.tile', len(frames) * combined.size * np.dtype(dtype).itemsize)
+    return combined
+
+
+def reduce_tile_in_worker(stack, method, metrics, **options):
+    # Process-backend task: reduce one stacked tile in the worker and send its Metrics rows back with it
+    Metrics.start_worker(metrics)
+    with timer('combine.tile'):
+        combined = reduce_stack(stack, method, **options)
+    count_bytes('combine.tile', stack.nbytes)
+    return combined, Metrics.report() if metrics else []
+
+
+def combine_frames(frames, method='mean', dtype=np.float64, max_memory=DEFAULT_MAX_MEMORY,
+                   sigma=3.0, maxiters=5, n_low=1, n_high=1, offset=None, scales=None,
+                   workers=1, backend='thread', ignore_nan=False):
+    """Combine a list of equally sized frames pixel by pixel, streaming over row tiles.
+
+    method is 'mean' (running mean), 'median', 'sigma_clip' (sigma-clipped mean) or 'minmax' (mean
+    after dropping the n_low lowest and n_high highest values). dtype is the accumulator and output
+    dtype. offset (a frame) is subtracted from and scales[i] divided out of frame i before combining.
+    workers > 1 combines tiles on a 'thread' or 'process' pool (None uses every core). With ignore_nan,
+    NaN pixels are left out of every method, so a pixel is only NaN where every frame is.
+    """
+    if method not in COMBINE_METHODS:
+        raise ValueError(f"Unknown combine method '{method}', expected one of {COMBINE_METHODS}")
+    if backend not in ('thread', 'process'):
+        raise ValueError(f"Unknown backend '{backend}', expected 'thread' or 'process'")
+    frames = list(frames)
+    if not frames:
+        raise ValueError("No frames to combine")
+    if method == 'minmax' and n_low + n_high >= len(frames):
+        raise ValueError(f"Cannot reject {n_low} low and {n_high} high values from {len(frames)} frames")
+
+    n_rows, n_cols = frames[0].shape
+    for frame in frames:
+        if frame.shape != (n_rows, n_cols):
+            raise ValueError(f"Frame shape {frame.shape} does not match {(n_rows, n_cols)}")
+
+    workers = workers or os.cpu_count()
+    options = dict(sigma=sigma, maxiters=maxiters, n_low=n_low, n_high=n_high, ignore_nan=ignore_nan)
+    combined = np.empty((n_rows, n_cols), dtype=dtype)
+
+    # The process backend ships a stacked tile to the worker, and the running mean can't skip NaNs, so in
+    # those cases even the mean needs the full stack
+    stacked_mean = ignore_nan or (backend == 'process' and workers > 1)
+    tile_method = 'median' if (stacked_mean and method == 'mean') else method
+    tile_rows = tile_rows_for(tile_method, len(frames), n_cols, dtype, max_memory // workers)
+
+    if workers == 1:
+        for rows in row_tiles(n_rows, tile_rows):
+            combined[rows] = combine_tile(frames, rows, method, dtype, offset, scales, **options)
+        return combined
+
+    tile_rows = min(tile_rows, max(1, -(-n_rows // (workers * _TILES_PER_WORKER))))
+    executor_class = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+
+    def collect(done_rows, done):
+        if backend == 'thread':
+            combined[done_rows] = done.result()
+        else:
+            combined[done_rows], metrics_rows = done.result()
+            Metrics.merge(metrics_rows)
+
+    with executor_class(max_workers=workers) as pool:
+        # At most `workers` tiles are in flight, which is what keeps memory inside max_memory
+        pending = deque()
+        for rows in row_tiles(n_rows, tile_rows):
+            if backend == 'thread':
+                future = pool.submit(combine_tile, frames, rows, method, dtype, offset, scales, **options)
+            else:
+                stack = stacked_tile(frames, rows, dtype, offset, scales)
+                future = pool.submit(reduce_tile_in_worker, stack, method, Metrics.is_enabled(), **options)
+            pending.append((rows, future))
+            if len(pending) >= workers:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+    return combined
+
+
+class DiskFrame:
+    """One frame of a DiskStack. Slicing rows reads just those rows from the file."""
+    def __init__(self, stack, index):
+        self.stack = stack
+        self.index = index
+        self.shape = stack.shape
+        self.dtype = stack.dtype
+        self.ndim = 2
+        self.size = self.shape[0] * self.shape[1]
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        start, stop, step = rows.indices(self.shape[0])
+        tile = self.stack.read_rows(self.index, start, stop)
+        return tile[::step, cols]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+class DiskStack:
+    """A (n_frames, rows, columns) stack kept in a temporary .npy file on disk.
+
+    Used when the frames to combine are produced on the fly (aligned or calibrated frames): each one is
+    written into the stack as it is made, and combine_frames then reads the stack tile by tile, so
+    memory stays flat however many frames there are. Frames are written and read with plain file I/O
+    rather than a memmap, so the stack never counts towards the process's resident memory. The file is
+    removed when the context exits.
+    """
+    def __init__(self, n_frames, shape, dtype=np.float32, directory=None):
+        self.n_frames = n_frames
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        fd, self.path = tempfile.mkstemp(suffix='.npy', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        # A standard .npy header, so the file can be inspected with np.load while debugging
+        np.lib.format.write_array_header_1_0(self.file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                         'fortran_order': False, 'shape': (n_frames,) + self.shape})
+        self.offset = self.file.tell()
+        self.file.truncate(self.offset + n_frames * self.frame_bytes)
+        self.lock = threading.Lock()  # frames are read from combine_frames' worker threads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.n_frames
+
+    def __setitem__(self, i, frame):
+        frame = np.ascontiguousarray(frame, dtype=self.dtype)
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match the stack's {self.shape}")
+        with self.lock:
+            self.file.seek(self.offset + i * self.frame_bytes)
+            frame.tofile(self.file)
+
+    def read_rows(self, i, start, stop):
+        row_bytes = self.shape[1] * self.dtype.itemsize
+        with self.lock:
+            self.file.seek(self.offset + i * self.frame_bytes + start * row_bytes)
+            tile = np.fromfile(self.file, dtype=self.dtype, count=(stop - start) * self.shape[1])
+        return tile.reshape(stop - start, self.shape[1])
+
+    @property
+    def frames(self):
+        return [DiskFrame(self, i) for i in range(self.n_frames)]
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            print(f"Could not remove temporary stack {self.path}: {e}")
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+from astropy.io import fits
+
+# Persistent SQLite index of FITS headers (path, mtime, filter, frame type, object, exposure, date).
+# refresh() only reads the primary header of files that are new or have changed since the last run,
+# so finding the science frames of a filter is a query instead of opening every file in the tree.
+
+FILTER_KEYWORDS = ['FILTER', 'FILT', 'FILTER1', 'FILTERNAME']
+
+FILTER_MAP = {
+    'B': ['B', 'BLUE', 'B-BAND'],
+    'V': ['V', 'VISUAL', 'V-BAND'],
+    'R': ['R', 'RED', 'R-BAND'],
+    'U': ['U', 'ULTRAVIOLET', 'U-BAND'],
+    'HALPHA': ['HALPHA', 'HA', 'H-ALPHA'],
+    'OIII': ['OIII', 'O-III', 'O III', '[OIII]'],
+    'SII': ['SII', 'S-II', 'S II', '[SII]']
+}
+
+CALIBRATION_TYPES = ['bias', 'dark', 'flat']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    filter TEXT,
+    filter_raw TEXT,
+    frame_type TEXT,
+    object TEXT,
+    exptime REAL,
+    date_obs TEXT,
+    airmass REAL
+)
+'''
+
+
+def header_filter_name(header):
+    """Standard filter name (a FILTER_MAP key) from the FITS header, or None."""
+    filter_raw = None
+    for keyword in FILTER_KEYWORDS:
+        if keyword in header:
+            filter_raw = str(header[keyword]).upper()
+            break
+
+    if not filter_raw:
+        return None
+
+    for std_name, variations in FILTER_MAP.items():
+        if any(var in filter_raw for var in variations):
+            return std_name
+    return None
+
+
+def is_science_header(header):
+    """A frame with an OBJECT that is not a bias, dark or flat."""
+    frame_type = str(header.get('IMAGETYP', '')).lower()
+    object_name = str(header.get('OBJECT', '')).lower()
+    return bool(object_name) and not any(cal_type in frame_type for cal_type in CALIBRATION_TYPES)
+
+
+def _header_float(header, keyword):
+    try:
+        return float(header[keyword]) if keyword in header else None
+    except (TypeError, ValueError):
+        return None
+
+
+class HeaderIndex:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        index_dir = os.path.dirname(index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute(_SCHEMA)
+        self.connection.execute('CREATE INDEX IF NOT EXISTS frames_filter ON frames (filter)')
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, root):
+        """Bring the index up to date with the FITS files below root. Returns the number of headers read."""
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                 self.connection.execute('SELECT path, mtime_ns, size FROM frames')}
+        seen = set()
+        rows = []
+        for dir_path, dirs, files in os.walk(root):
+            for file_name in files:
+                if not file_name.endswith('.fits'):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                seen.add(file_path)
+                stat = os.stat(file_path)
+                if known.get(file_path) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                try:
+                    header = fits.getheader(file_path)  # reads the primary header blocks only
+                except Exception as e:
+                    print(f"Error processing {file_path}: {str(e)}")
+                    continue
+                filter_raw = next((str(header[k]) for k in FILTER_KEYWORDS if k in header), None)
+                rows.append((file_path, stat.st_mtime_ns, stat.st_size, header_filter_name(header), filter_raw,
+                             str(header.get('IMAGETYP', '')), str(header.get('OBJECT', '')),
+                             _header_float(header, 'EXPTIME'), header.get('DATE-OBS'),
+                             _header_float(header, 'AIRMASS')))
+
+        # Forget files that were removed from this part of the tree
+        root_prefix = os.path.join(root, '')
+        removed = [(path,) for path in known if path.startswith(root_prefix) and path not in seen]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.executemany('DELETE FROM frames WHERE path = ?', removed)
+        if rows or removed:
+            print(f"Header index {self.index_path}: {len(rows)} updated, {len(removed)} removed")
+        return len(rows)
+
+    def _science_condition(self):
+        # SQL version of is_science_header
+        return "object != '' AND " + ' AND '.join(
+            f"lower(frame_type) NOT LIKE '%{cal_type}%'" for cal_type in CALIBRATION_TYPES)
+
+    def filter_name(self, path):
+        row = self.connection.execute('SELECT filter FROM frames WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def is_science_frame(self, path):
+        row = self.connection.execute(
+            f'SELECT 1 FROM frames WHERE path = ? AND {self._science_condition()}', (path,)).fetchone()
+        return row is not None
+
+    def science_frames(self, filter_name, root=None):
+        """Sorted paths of the science frames taken with filter_name (optionally only below root)."""
+        query = f'SELECT path FROM frames WHERE filter = ? AND {self._science_condition()}'
+        params = [filter_name.upper()]
+        if root is not None:
+            query += ' AND substr(path, 1, ?) = ?'
+            root_prefix = os.path.join(root, '')
+            params += [len(root_prefix), root_prefix]
+        return [row[0] for row in self.connection.execute(query + ' ORDER BY path', params)]
+
+    def frame_info(self, path):
+        """Indexed header values of one file as a dict, or None if it is not indexed."""
+        cursor = self.connection.execute('SELECT * FROM frames WHERE path = ?', (path,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
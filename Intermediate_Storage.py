@@ -0,0 +1,102 @@
+import os
+import numpy as np
+from astropy.io import fits
+from Frame_Catalogue import open_frame
+
+# On-disk formats for the intermediate frames (reduced frames, science stacks). The default 'fits' is
+# the plain float32 PrimaryHDU the pipeline always wrote. The other formats trade a little precision
+# for much smaller files that are quicker to read back:
+#   'rice'      tile-compressed FITS, RICE_1 with quantization (floats are quantized to noise / quantize_level)
+#   'hcompress' tile-compressed FITS, HCOMPRESS_1 with quantization (smaller still, for smooth images)
+#   'npy'       a raw .npy array in float32 or float16 with the FITS header next to it in a .hdr file
+# Compressed files are split into square tiles and .npy files are memory mapped, so read_section() only
+# decompresses or reads the part of the frame a cutout needs.
+
+STORAGE_FORMATS = ['fits', 'rice', 'hcompress', 'npy']
+
+_COMPRESSION_TYPES = {'rice': 'RICE_1', 'hcompress': 'HCOMPRESS_1'}
+
+DEFAULT_TILE_SHAPE = (256, 256)
+DEFAULT_QUANTIZE_LEVEL = 16.0  # astropy's default: quantization step = background noise / 16
+
+
+def storage_path(path, storage='fits'):
+    """path with the extension used by the storage format."""
+    root, _ = os.path.splitext(path)
+    return root + ('.npy' if storage == 'npy' else '.fits')
+
+
+def header_path(npy_path):
+    return os.path.splitext(npy_path)[0] + '.hdr'
+
+
+def write_frame(path, data, header=None, storage='fits', quantize_level=DEFAULT_QUANTIZE_LEVEL,
+                tile_shape=DEFAULT_TILE_SHAPE, precision='float32'):
+    """Write one frame in the given storage format and return the path actually written.
+
+    quantize_level and tile_shape apply to the compressed formats, precision ('float32' or 'float16')
+    to 'npy'. The extension of path is replaced to match the format.
+    """
+    if storage not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown storage format '{storage}', expected one of {STORAGE_FORMATS}")
+    path = storage_path(path, storage)
+    header = fits.Header() if header is None else header
+
+    if storage == 'npy':
+        np.save(path, np.asarray(data, dtype=precision))
+        with open(header_path(path), 'w') as f:
+            f.write(header.tostring())
+    elif storage == 'fits':
+        fits.PrimaryHDU(np.asarray(data, dtype=np.float32), header=header).writeto(path, overwrite=True)
+    else:
+        # Tiles are clipped to the frame so small frames still compress
+        tile_shape = tuple(min(t, n) for t, n in zip(tile_shape, data.shape))
+        hdu = fits.CompImageHDU(np.asarray(data, dtype=np.float32), header=header,
+                                compression_type=_COMPRESSION_TYPES[storage], quantize_level=quantize_level,
+                                quantize_method=1, tile_shape=tile_shape)  # SUBTRACTIVE_DITHER_1
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+    return path
+
+
+def _image_hdu(hdul):
+    # Compressed images live in the first extension, behind an empty primary HDU
+    if hdul[0].data is None and len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return hdul[1]
+    return hdul[0]
+
+
+def is_compressed(path):
+    with fits.open(path) as hdul:
+        return isinstance(_image_hdu(hdul), fits.CompImageHDU)
+
+
+def read_frame(path):
+    """(data, header) of a frame in any storage format. Plain FITS and .npy data are memory mapped."""
+    if path.endswith('.npy'):
+        with open(header_path(path)) as f:
+            header = fits.Header.fromstring(f.read())
+        return np.load(path, mmap_mode='r'), header
+    with fits.open(path) as hdul:
+        hdu = _image_hdu(hdul)
+        if isinstance(hdu, fits.CompImageHDU):
+            return hdu.data, hdu.header
+    return open_frame(path)
+
+
+def read_section(path, rows, cols):
+    """Cutout data[rows, cols] (two slices) reading or decompressing only the tiles it overlaps."""
+    if path.endswith('.npy'):
+        return np.array(np.load(path, mmap_mode='r')[rows, cols])
+    with fits.open(path) as hdul:
+        hdu = _image_hdu(hdul)
+        if isinstance(hdu, fits.CompImageHDU):
+            return hdu.section[rows, cols]
+    data, _ = open_frame(path)
+    return np.array(data[rows, cols])
+
+
+def frame_files(directory, storage=None):
+    """Sorted paths of the frames in a directory written in the given storage format (its extension only,
+    so frames left over from a run with another format aren't picked up too); all of them if storage is None."""
+    extensions = ('.fits', '.npy') if storage is None else (storage_path('', storage),)
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(extensions))
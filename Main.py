@@ -4,78 +4,141 @@ import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from Frame_Catalogue import FrameCatalogue, open_frame, trim_section_for
+from Metrics import timer, count_bytes
 
 # Have a look at README.MD before replacing the base_dir to make sure your folder has the same structure. This code is built for only that kind of structure
 # This is the directory to your data folder. Replace it with your own folder directory
 base_dir = 'G:\MyProject\TGP\observation_data'
 
-# Function to remove the specified regions from the FITS data
-def trim_fits_data(data):
-    # Keep everything except the first region (rows 0:4096 and columns 4060:4096) 
-    # We remove the columns 4060 to 4096 from the data (0 is the bottom, top is 4096)
-    trimmed_data = np.delete(data, np.s_[4060:4097], axis=1)     # Remember that python slicing is exclusive of the end index as in this case 4096 is not included. axis=1 means we are removing columns and axis=0 means we are removing rows
-    
-    # removed the second region (rows 4076:4096 and columns 0:4096)
-    # We remove the rows 4050 to 4096
-    trimmed_data = np.delete(trimmed_data, np.s_[4050:4097], axis=0)
-
-    # removed the third  region (rows 0:60and columns 0:4096)
-    # We remove the rows 0 to 60
-    trimmed_data = np.delete(trimmed_data, np.s_[0:60], axis=0)
-    
+# This is where the reduced products (master frames, reduced images) are written and read back from
+reduction_dir = 'G:/MyProject/TGP/data_reduction'
+master_bias_path = os.path.join(reduction_dir, 'Master_Bias', 'master_bias.fits')
+master_dark_path = os.path.join(reduction_dir, 'Master_Dark', 'master_dark.fits')
+master_flats_dir = os.path.join(reduction_dir, 'Flats', 'Master')
+
+def master_flat_path(band):
+    return os.path.join(master_flats_dir, f'Master_Flat_{band}.fits')
+
+# Function to remove the overscan regions from the FITS data
+def trim_fits_data(data, header=None, detector='default'):
+    # The kept region is one precomputed slice (rows 60:4050 and columns 0:4060 for the default detector),
+    # so this returns a view instead of copying the frame three times with np.delete.
+    # Pass the header to use its TRIMSEC/DATASEC keyword instead; add other detectors to DETECTOR_TRIM_SECTIONS in Frame_Catalogue.py
+    return data[trim_section_for(header, detector)]
+
+# Function to read one file and return its trimmed pixels in memory (used by the ingest pool below)
+def read_trimmed_fits_file(file_path, detector='default', use_header_section=False):
+    with timer('ingest.read'):
+        data, header = open_frame(file_path)
+        trimmed_data = np.array(trim_fits_data(data, header if use_header_section else None, detector))
+    count_bytes('ingest.read', trimmed_data.nbytes)
     return trimmed_data
 
-# Function to read, trim, and return modified FITS data
-def load_and_trim_fits_files(directory):
-    trimmed_files = []
-    for file_name in os.listdir(directory):
-        if file_name.endswith('.fits'):
-            file_path = os.path.join(directory, file_name)
-            data = fits.getdata(file_path, memmap=False) 
-            trimmed_data = trim_fits_data(data)  
-            trimmed_files.append(trimmed_data)  
-    return trimmed_files
-
-Bias = []
-Flats = {'B-Band': [], 'U-Band': [], 'V-Band': []}
-M52 = {'B-band': [], 'U-band': [], 'V-band': []}
-NGC7789 = {'B-band': [], 'U-band': [], 'V-band': []}
-Standard_Star_1 = {'B-band': [], 'U-band': [], 'V-band': []}
-Standard_Star_2 = {'B-band': [], 'U-band': [], 'V-band': []}
-
-# Load and trim Bias data
-bias_dir = os.path.join(base_dir, 'Calibration', 'Bias')
-Bias = load_and_trim_fits_files(bias_dir)
-
-# Load and trim Flats data for B-Band, U-Band, and V-Band
-flats_dir = os.path.join(base_dir, 'Calibration', 'Flats')
-for band in ['B-Band', 'U-Band', 'V-Band']:
-    band_dir = os.path.join(flats_dir, band)
-    Flats[band] = load_and_trim_fits_files(band_dir)
-
-# Load and trim data for M52
-for band in ['B-band', 'U-band', 'V-band']:
-    dir_path = os.path.join(base_dir, 'M52', band)
-    M52[band] = load_and_trim_fits_files(dir_path)
-
-# Load and trim data for NGC7789
-for band in ['B-band', 'U-band', 'V-band']:
-    dir_path = os.path.join(base_dir, 'NGC7789', band)
-    NGC7789[band] = load_and_trim_fits_files(dir_path)
-
-# Load and trim data for Standard Star 1
-for band in ['B-band', 'U-band', 'V-band']:
-    Standard_Star_1[band] = []
-    for observation in ['First observation', 'Second observation', 'Third observation']:
-        dir_path = os.path.join(base_dir, 'Standard Star 1', band, observation)
-        Standard_Star_1[band].extend(load_and_trim_fits_files(dir_path))
-
-# Load and trim data for Standard Star 2
-for band in ['B-band', 'U-band', 'V-band']:
-    Standard_Star_2[band] = []
-    for observation in ['First observation', 'Second observation', 'Third observation']:
-        dir_path = os.path.join(base_dir, 'Standard Star 2', band, observation)
-        Standard_Star_2[band].extend(load_and_trim_fits_files(dir_path))
+def _trimmed_frames(file_paths, detector, use_header_section, workers, backend, max_in_flight):
+    if workers is None:
+        for file_path in file_paths:
+            with timer('ingest.open'):
+                data, header = open_frame(file_path)  # memory-mapped, the trim below only reads the kept region
+                trimmed_data = trim_fits_data(data, header if use_header_section else None, detector)
+            yield trimmed_data
+        return
+
+    max_in_flight = max_in_flight or 2 * workers
+    executor_class = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+    with executor_class(max_workers=workers) as pool:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append(pool.submit(read_trimmed_fits_file, file_path, detector, use_header_section))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Generator that reads and trims the FITS files of a directory, one frame at a time
+def iter_trimmed_fits_files(directory, detector='default', use_header_section=False,
+                            workers=None, backend='thread', max_in_flight=None, report=True):
+    # Frames are yielded in sorted file-name order, so the caller can process and drop each one before the next.
+    # workers=None yields memory-mapped trimmed views (pixels are read when used). With workers=N the
+    # pixels are read ahead on a pool of N threads ('thread') or processes ('process'), which hides the
+    # latency of network/HDD storage. At most max_in_flight files (default 2*N) are being read or waiting
+    # to be yielded, so memory stays capped at that many frames plus whatever the caller keeps.
+    # With report, files/s and MB/s are printed at the end, over the time spent in here (opening, reading or
+    # waiting for a read) and not the caller's time between frames.
+    file_paths = [os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))
+                  if file_name.endswith('.fits')]
+    frames = _trimmed_frames(file_paths, detector, use_header_section, workers, backend, max_in_flight)
+    n_bytes = 0
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            trimmed_data = next(frames, None)
+            elapsed += time.perf_counter() - start
+            if trimmed_data is None:
+                break
+            n_bytes += trimmed_data.nbytes
+            yield trimmed_data
+    finally:
+        frames.close()
+
+    if report and file_paths and elapsed > 0:
+        # With workers=None the frames are mapped views, so the bytes are those the trim maps, not reads
+        print(f"{'Opened' if workers is None else 'Read'} {len(file_paths)} files from {directory} in {elapsed:.2f} s "
+              f"({len(file_paths) / elapsed:.1f} files/s, {n_bytes / 1024**2 / elapsed:.1f} MB/s)")
+
+# Function to read, trim, and return modified FITS data: every frame of iter_trimmed_fits_files in one list
+def load_and_trim_fits_files(directory, detector='default', use_header_section=False,
+                             workers=None, backend='thread', max_in_flight=None, report=True):
+    return list(iter_trimmed_fits_files(directory, detector, use_header_section, workers, backend,
+                                        max_in_flight, report))
+
+# Frames are no longer read when Main is imported. The catalogue only indexes headers, and each
+# dictionary below is built from memory-mapped, trimmed views the first time a script imports it,
+# e.g. `from Main import Bias` only touches the bias files.
+catalogue = FrameCatalogue(base_dir)
+
+bands = ['B-band', 'U-band', 'V-band']
+flat_bands = ['B-Band', 'U-Band', 'V-Band']
+observations = ['First observation', 'Second observation', 'Third observation']
+
+def load_bias():
+    return catalogue.load_all('Bias')
+
+def load_darks():
+    return catalogue.load_all('Dark')
+
+def load_flats():
+    return {band: catalogue.load_all('Flats', band) for band in flat_bands}
+
+def load_object(obj_name):
+    # For the standard stars the First/Second/Third observation folders are read in that order
+    return {band: catalogue.load_all(obj_name, band) for band in bands}
+
+_lazy_frames = {
+    'Bias': load_bias,
+    'Dark': load_darks,
+    'Flats': load_flats,
+    'M52': lambda: load_object('M52'),
+    'NGC7789': lambda: load_object('NGC7789'),
+    'Standard_Star_1': lambda: load_object('Standard Star 1'),
+    'Standard_Star_2': lambda: load_object('Standard Star 2'),
+}
+_lazy_aliases = {'m52': 'M52', 'ngc7789': 'NGC7789'}  # Data_Reduction.py imports the lower-case names
+
+def __getattr__(name):
+    canonical = _lazy_aliases.get(name, name)
+    if canonical not in _lazy_frames:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = _lazy_frames[canonical]()
+    globals()[canonical] = value
+    for alias, target in _lazy_aliases.items():
+        if target == canonical:
+            globals()[alias] = value
+    return value
 
 # Example: on how to access and plot the data
 # plt.imshow(Bias[0], cmap='viridis')
@@ -0,0 +1,231 @@
+import os
+import csv
+import json
+import time
+import threading
+import functools
+from datetime import datetime
+
+try:
+    import psutil  # optional, used for the memory samples when installed
+except ImportError:
+    psutil = None
+
+# Lightweight run instrumentation. Stages wrap their work in timer('name') (a context manager or a
+# decorator) and report data volumes with count_bytes('name', n); a background thread samples the
+# process RSS so every timer also records the peak memory seen while it was open. write_report() exports
+# one row per timer name as JSON or CSV, and enable(profile_path=...) profiles the run with cProfile
+# until disable(), which writes the dump (open it with snakeviz, or make a flame graph with flameprof).
+#
+# Everything is off until enable() is called; disabled timers return immediately, so the instrumentation
+# can stay in the stage code. Work done in a process pool is timed in the worker: the task calls
+# start_worker(enabled) with the parent's is_enabled(), returns report() with its result, and the parent
+# folds those rows into its own stats with merge(). Setting TGP_METRICS=<report path> (and optionally TGP_PROFILE=<dump path>)
+# enables it for any script and writes the report when the script exits.
+
+_enabled = False
+_lock = threading.Lock()
+_stats = {}       # name -> {'calls', 'seconds', 'bytes', 'peak_rss_mb'}
+_open = {}        # name -> number of timers with that name currently running
+_sampler = None
+_profiler = None
+_profile_path = None
+
+
+def _rss_mb():
+    """Current resident set size in MB, or None where it can't be measured."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024**2
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _entry(name):
+    return _stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'peak_rss_mb': None})
+
+
+def _record_peak(rss):
+    # Called with the lock held: the sample counts towards every timer that is open right now
+    for name, count in _open.items():
+        if count:
+            entry = _entry(name)
+            if entry['peak_rss_mb'] is None or rss > entry['peak_rss_mb']:
+                entry['peak_rss_mb'] = rss
+
+
+class _MemorySampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = _rss_mb()
+            if rss is None:
+                return
+            with _lock:
+                _record_peak(rss)
+
+
+def enable(sample_interval=0.05, profile_path=None):
+    """Start collecting. sample_interval is the RSS sampling period in seconds (None: no sampling).
+    With profile_path everything until disable() is profiled and the cProfile dump written there."""
+    global _enabled, _sampler, _profiler, _profile_path
+    _enabled = True
+    # A forked worker inherits the parent's sampler object but not its thread
+    if sample_interval and (_sampler is None or not _sampler.is_alive()):
+        _sampler = _MemorySampler(sample_interval)
+        _sampler.start()
+    if profile_path and _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profile_path = profile_path
+        _profiler.enable()
+
+
+def disable():
+    global _enabled, _sampler, _profiler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.stopped.set()
+        _sampler = None
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        print(f"Profile written to {_profile_path}")
+        _profiler = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def start_worker(enabled):
+    """Start a task in a pool worker process: drop the stats inherited from the parent or left by the
+    worker's previous task, and collect only if enabled (the parent's is_enabled())."""
+    global _enabled
+    reset()
+    if enabled:
+        enable()
+    else:
+        _enabled = False
+
+
+def merge(rows):
+    """Add the report() rows of another process to these stats. Calls, seconds and bytes add up; the
+    peak RSS is the largest of the processes' (each process's own, they are not summed)."""
+    if not _enabled:
+        return
+    with _lock:
+        for row in rows:
+            entry = _entry(row['name'])
+            entry['calls'] += row['calls']
+            entry['seconds'] += row['seconds']
+            entry['bytes'] += row['bytes']
+            peak = row['peak_rss_mb']
+            if peak is not None and (entry['peak_rss_mb'] is None or peak > entry['peak_rss_mb']):
+                entry['peak_rss_mb'] = peak
+
+
+class timer:
+    """Time a block (`with timer('bias.combine'):`) or every call of a function (`@timer('photometry')`).
+
+    Timers with the same name add up; nested and concurrent timers are fine.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if not _enabled:
+            return self
+        with _lock:
+            _open[self.name] = _open.get(self.name, 0) + 1
+            rss = _rss_mb() if _sampler is not None else None
+            if rss is not None:
+                _record_peak(rss)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return False
+        seconds = time.perf_counter() - self.start
+        self.start = None
+        with _lock:
+            rss = _rss_mb() if _sampler is not None else None
+            if rss is not None:
+                _record_peak(rss)
+            _open[self.name] -= 1
+            entry = _entry(self.name)
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with timer(self.name):
+                return function(*args, **kwargs)
+        return timed
+
+
+def count_bytes(name, n_bytes):
+    """Add n_bytes of data read or written to the stats of name (usually the name of the enclosing timer)."""
+    if not _enabled:
+        return
+    with _lock:
+        _entry(name)['bytes'] += int(n_bytes)
+
+
+def report():
+    """One dict per timer name: calls, total seconds, bytes, MB/s and the peak RSS while it ran."""
+    rows = []
+    with _lock:
+        for name, entry in sorted(_stats.items()):
+            seconds = entry['seconds']
+            rows.append({'name': name, 'calls': entry['calls'], 'seconds': round(seconds, 6),
+                         'bytes': entry['bytes'],
+                         'mb_per_s': round(entry['bytes'] / 1024**2 / seconds, 3) if seconds > 0 and entry['bytes'] else None,
+                         'peak_rss_mb': None if entry['peak_rss_mb'] is None else round(entry['peak_rss_mb'], 1)})
+    return rows
+
+
+def write_report(path):
+    """Write the report as CSV (.csv) or JSON (anything else)."""
+    rows = report()
+    report_dir = os.path.dirname(path)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['name', 'calls', 'seconds', 'bytes', 'mb_per_s', 'peak_rss_mb'])
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'stages': rows}, f, indent=1)
+    print(f"Metrics report written to {path}")
+    return rows
+
+
+def _write_at_exit(path):
+    write_report(path)
+    disable()
+
+
+if os.environ.get('TGP_METRICS'):
+    import atexit
+    enable(profile_path=os.environ.get('TGP_PROFILE') or None)
+    atexit.register(_write_at_exit, os.environ['TGP_METRICS'])
@@ -1,10 +1,18 @@
 import numpy as np
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats, sigma_clip
-from photutils.detection import DAOStarFinder
-from photutils.psf import fit_fwhm
+from photutils.detection import DAOStarFinder, find_peaks
 from photutils.aperture import CircularAperture, CircularAnnulus, aperture_photometry
+from Annulus_Background import annulus_background
+from Curve_Of_Growth import multi_aperture_photometry, curve_of_growth
+from Batch_FWHM import batch_fwhm, clipped_median_fwhm
+from Background_Mesh import background_maps
+import Metrics
+from Metrics import timer
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from astropy.table import Table, vstack
+from Photometry_Catalogue import PhotometryCatalogue
 
 # List of all reduced image paths.     
 reduced_image_paths = [
@@ -47,78 +55,85 @@ reduced_image_paths = [
     (r'G:\MyProject\TGP\data_reduction\Normalized Aligned Stacked Images\Standard Star 2\V-band\Third Observation\SS2 normalized_Stacked_Third Observation V.fits', 'Standard_Star_2_V_3rd'),
 ]
 
-# Dictionary to store results for each image
-results = {}
-
-# Loop through each reduced image path
-for image_path, label in reduced_image_paths:
+# Aperture radii in units of the FWHM. The default is the single 3 x FWHM aperture.
+DEFAULT_RADII_FACTORS = (3.0,)
+CURVE_OF_GROWTH_FACTORS = (1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0)
+
+def find_fwhm_candidates(detection_data, threshold, fwhm_guess, n_stars, border=10):
+    # Positions of the n_stars brightest local maxima away from the edges, for the first FWHM fit.
+    # find_peaks is a single maximum filter over the frame, much cheaper than a DAOStarFinder pass.
+    box_size = 2 * int(np.ceil(fwhm_guess)) + 1
+    peaks = find_peaks(detection_data, threshold, box_size=box_size, border_width=border)
+    if peaks is None or len(peaks) == 0:
+        return np.empty((0, 2))
+    peaks.sort('peak_value', reverse=True)
+    peaks = peaks[:n_stars]
+    return np.transpose((peaks['x_peak'], peaks['y_peak'])).astype(float)
+
+def measure_image(image_path, label, radii_factors=DEFAULT_RADII_FACTORS):
+    # Detection, FWHM measurement and aperture photometry of one stacked image. Returns the photometry
+    # table, or None if the image is missing or has no usable sources.
+    # radii_factors are the aperture radii in units of the FWHM; give several (e.g. CURVE_OF_GROWTH_FACTORS)
+    # to measure them all in one pass and keep the best-SNR radius, with 'total_mag' aperture corrected.
     print(f"Processing: {label}")
 
     # Ensure the file exists
     if not os.path.exists(image_path):
         print(f"File not found: {image_path}")
-        continue
+        return None
 
     with fits.open(image_path) as hdul:
         data = hdul[0].data.astype(np.float32)  # convert to float32 to save memory
-        mean, median, std = sigma_clipped_stats(data, sigma=3.0)
+
+        # Smooth background and noise maps from clipped statistics on a coarse grid (see Background_Mesh.py),
+        # so detection follows sky gradients and thresholds against the local noise
+        with timer('photometry.background_mesh'):
+            background, rms = background_maps(data)
+
+        # Background-subtracted image, computed once and reused by every detection step below
+        detection_data = np.subtract(data, background, out=np.empty_like(data))
 
         # --- 1. First pass: initial FWHM guess ---
         initial_fwhm_guess = 3.0
-        detection_threshold = 3.0 * std
+        detection_threshold = 3.0 * rms  # a map: find_peaks takes a per-pixel threshold
 
-        daofind_init = DAOStarFinder(fwhm=initial_fwhm_guess, threshold=detection_threshold)
-        sources_init = daofind_init(data - median)
+        # The first pass only needs bright, isolated stars to measure the FWHM, so a cheap local-maximum
+        # search replaces the full DAOStarFinder run that used to happen here. DAOStarFinder then runs once,
+        # with the measured FWHM.
+        n_fwhm_stars_first_pass = 100  # e.g. measure FWHM on the top 100 brightest
+        xypos_init = find_fwhm_candidates(detection_data, detection_threshold, initial_fwhm_guess,
+                                          n_fwhm_stars_first_pass, border=10)
 
-        if sources_init is None or len(sources_init) == 0:
+        if len(xypos_init) == 0:
             print(f"No sources found for {label} in first pass. Skipping.")
-            continue
-
-        # Filter out edge sources (example: 10-pixel border)
-        mask = (
-            (sources_init['xcentroid'] > 10) &
-            (sources_init['xcentroid'] < data.shape[1] - 10) &
-            (sources_init['ycentroid'] > 10) &
-            (sources_init['ycentroid'] < data.shape[0] - 10)
-        )
-        sources_init = sources_init[mask]
-
-        if len(sources_init) == 0:
-            print(f"All detected sources were near edges for {label}, skipping.")
-            continue
-
-        # Sort initial sources by flux (descending)
-        sources_init.sort('flux', reverse=True)
-
-        # Limit the number of stars used for FWHM measurement (1st pass)
-        n_fwhm_stars_first_pass = 100  # e.g. measure FWHM on the top 100 brightest
-        top_sources_first_pass = sources_init[:n_fwhm_stars_first_pass]
-        xypos_init = np.transpose((top_sources_first_pass['xcentroid'],
-                                   top_sources_first_pass['ycentroid']))
+            return None
 
         try:
-            # Measure the FWHM from these top N stars
-            fwhm_values_init = fit_fwhm(data, xypos=xypos_init, fit_shape=7)
-
-            # Filter out non-converged fits
-            good_mask = np.isfinite(fwhm_values_init) & (fwhm_values_init > 0)
-            fwhm_values_init = fwhm_values_init[good_mask]
-
-            if len(fwhm_values_init) == 0:
+            # Measure the FWHM from these top N stars, all fitted at once (see Batch_FWHM.py). The fit is
+            # on the background-subtracted image, as the Gaussian model has no sky term.
+            with timer('photometry.fit_fwhm'):
+                fwhm_values_init, _, _ = batch_fwhm(detection_data, xypos_init, fit_shape=7)
+
+            # Non-converged fits are NaN and left out of the clipped median
+            median_fwhm_init = clipped_median_fwhm(fwhm_values_init)
+            if not np.isfinite(median_fwhm_init):
                 print(f"No valid FWHM fits for {label} in the first pass.")
-                continue
+                return None
 
-            fwhm_values_init_clipped = sigma_clip(fwhm_values_init, sigma=3.0, maxiters=5)
-            median_fwhm_init = np.median(fwhm_values_init_clipped[~fwhm_values_init_clipped.mask])
             print(f"{label}: First-pass median FWHM = {median_fwhm_init:.2f} pixels")
 
             # --- 2. Second pass: use measured FWHM for detection ---
-            daofind_refined = DAOStarFinder(fwhm=median_fwhm_init, threshold=detection_threshold)
-            sources = daofind_refined(data - median)
+            # DAOStarFinder only takes one threshold, so it runs on the signal-to-noise image with a
+            # threshold of 3 (the same 3 x local RMS as the first pass); only the centroids are used below
+            daofind_refined = DAOStarFinder(fwhm=median_fwhm_init, threshold=3.0)
+            with timer('photometry.detect'):
+                snr_data = np.divide(detection_data, rms, out=np.zeros_like(detection_data), where=rms > 0)
+                sources = daofind_refined(snr_data)
+                del snr_data
 
             if sources is None or len(sources) == 0:
                 print(f"No sources found for {label} in second pass. Skipping.")
-                continue
+                return None
 
             # Sort by flux again
             sources.sort('flux', reverse=True)
@@ -136,41 +151,61 @@ for image_path, label in reduced_image_paths:
             if fit_shape % 2 == 0:
                 fit_shape += 1
 
-            fwhm_values = fit_fwhm(data, xypos=xypos_2pass, fit_shape=fit_shape)
-
-            # Filter out invalid fits
-            good_mask = np.isfinite(fwhm_values) & (fwhm_values > 0)
-            fwhm_values = fwhm_values[good_mask]
+            with timer('photometry.fit_fwhm'):
+                fwhm_values, _, _ = batch_fwhm(detection_data, xypos_2pass, fit_shape=fit_shape)
 
-            if len(fwhm_values) == 0:
+            median_fwhm_clipped = clipped_median_fwhm(fwhm_values)
+            if not np.isfinite(median_fwhm_clipped):
                 print(f"No valid FWHM fits for {label} in second pass.")
-                continue
+                return None
 
-            fwhm_values_clipped = sigma_clip(fwhm_values, sigma=3.0, maxiters=5)
-            median_fwhm_clipped = np.median(fwhm_values_clipped[~fwhm_values_clipped.mask])
             print(f"{label} - Clipped Median FWHM (2nd pass): {median_fwhm_clipped:.2f} pixels")
 
             # --- Aperture Photometry ---
             # We do photometry on ALL sources from the second pass, not just the top N
             xypos_all = np.transpose((sources['xcentroid'], sources['ycentroid']))
 
+            # Annulus is placed relative to the standard 3 x FWHM aperture, outside every radius measured below
             aperture_radius = 3.0 * median_fwhm_clipped
             inner_radius = 2.0 * aperture_radius
             outer_radius = 3.0 * aperture_radius
+            radii = np.asarray(radii_factors) * median_fwhm_clipped
 
-            apertures = CircularAperture(xypos_all, r=aperture_radius)
             annulus_apertures = CircularAnnulus(xypos_all, r_in=inner_radius, r_out=outer_radius)
 
             n_sky = annulus_apertures.area
-            n_pix = apertures.area
+            n_pix = CircularAperture(xypos_all, r=radii.max()).area
             if n_sky <= n_pix:
                 print(f"Warning: Increase annulus size for {label} to ensure n_sky > n_pix.")
 
-            phot_table = aperture_photometry(data, apertures)
-            bkg_table = aperture_photometry(data, annulus_apertures)
-
-            bkg_mean = bkg_table['aperture_sum'] / annulus_apertures.area
-            phot_table['residual_aperture_sum'] = phot_table['aperture_sum'] - (bkg_mean * apertures.area)
+            # Sigma-clipped sky median and variance in every star's own annulus, in one batched pass
+            # (replaces a second aperture_photometry call for the annulus mean)
+            with timer('photometry.background'):
+                sky_median, sky_variance, _ = annulus_background(data, xypos_all, inner_radius, outer_radius)
+                # Annuli with no usable pixels (at the image edge) fall back to the background mesh
+                no_sky = ~np.isfinite(sky_median) | ~np.isfinite(sky_variance)
+                if no_sky.any():
+                    px = np.clip(np.round(xypos_all[no_sky, 0]).astype(int), 0, data.shape[1] - 1)
+                    py = np.clip(np.round(xypos_all[no_sky, 1]).astype(int), 0, data.shape[0] - 1)
+                    sky_median[no_sky] = background[py, px]
+                    sky_variance[no_sky] = rms[py, px] ** 2
+
+            # Every radius is measured in one aperture_photometry call; with more than one radius the
+            # curve of growth picks the radius with the best median SNR and gives the aperture correction
+            with timer('photometry.apertures'):
+                phot_table, net_flux, snr_all = multi_aperture_photometry(data, xypos_all, radii, sky_median, sky_variance)
+            growth, median_snr, best, aperture_correction = curve_of_growth(net_flux, snr_all)
+            if len(radii) > 1:
+                print(f"{label}: best aperture {radii[best]:.2f} pixels ({radii_factors[best]} x FWHM), "
+                      f"aperture correction {aperture_correction:.3f} mag")
+            phot_table.meta['fwhm'] = median_fwhm_clipped
+            phot_table.meta['aperture_radius'] = radii[best]
+            phot_table.meta['aperture_correction'] = aperture_correction
+            phot_table.meta['growth_radii'] = list(radii)
+            phot_table.meta['growth_curve'] = list(growth)
+
+            phot_table['residual_aperture_sum'] = net_flux[:, best]
+            phot_table['snr'] = snr_all[:, best]
 
             # Filter out non-positive flux
             positive_flux = phot_table['residual_aperture_sum'] > 0
@@ -179,33 +214,83 @@ for image_path, label in reduced_image_paths:
             # Calculate instrumental magnitudes
             phot_table['instrumental_mag'] = -2.5 * np.log10(phot_table['residual_aperture_sum'])
 
-            # NEW: Calculate SNR and magnitude errors
-            # Calculate sky background variance in the annulus
-            sky_variance = np.var(data[annulus_apertures.to_mask().get_overlap_slices(data)])
-            
-            # Calculate SNR for each source
-            signal = phot_table['residual_aperture_sum']
-            snr = signal / np.sqrt(signal + n_pix * sky_variance)
-            
-            # Calculate magnitude errors using dm = 1.086 * (1/SNR)
-            phot_table['snr'] = snr
-            phot_table['mag_error'] = 1.086 / snr
+            # Calculate magnitude errors using dm = 1.086 * (1/SNR), with the SNR from each star's own sky variance
+            phot_table['mag_error'] = 1.086 / phot_table['snr']
 
             # Store final results with new columns
-            results[label] = phot_table[['id', 'xcenter', 'ycenter',
-                                       'residual_aperture_sum', 'instrumental_mag',
-                                       'snr', 'mag_error']]
+            columns = ['id', 'xcenter', 'ycenter', 'residual_aperture_sum', 'instrumental_mag', 'snr', 'mag_error']
+            if len(radii) > 1:
+                phot_table['total_mag'] = phot_table['instrumental_mag'] + aperture_correction
+                columns.append('total_mag')
             print(f"Photometry results for {label} stored.")
+            return phot_table[columns]
 
         except Exception as e:
             print(f"Error processing {label}: {e}")
-
-# Display results
-for label, result in results.items():
-    print(f"\nResults for {label}:")
-    print(result)
-
-import pandas as pd
-
-# Save each set of results to a CSV file
-for label, photometry_data in results
+            return None
+
+
+def timed_measure_image(image_path, label, radii_factors=DEFAULT_RADII_FACTORS, metrics=None):
+    # Runs in a worker process, so the timing is measured where the work happens. metrics is None when this
+    # runs in the calling process (its Metrics timers record straight into that report); in a worker it is
+    # the parent's Metrics.is_enabled(), and the worker's Metrics rows come back with the result.
+    if metrics is not None:
+        Metrics.start_worker(metrics)
+    start = time.perf_counter()
+    phot_table = measure_image(image_path, label, radii_factors)
+    return label, phot_table, time.perf_counter() - start, Metrics.report() if metrics else []
+
+def run_photometry(image_paths, workers=None, radii_factors=DEFAULT_RADII_FACTORS, on_result=None):
+    # The images are independent, so they are spread over a process pool (workers=None uses every core,
+    # workers=1 runs them one after another in this process). Returns one table of every image's sources,
+    # keyed by a 'label' column and in the order of image_paths (the per-image meta such as the FWHM is not
+    # kept, write_catalogue keeps it), and a table with the time spent on every image.
+    # With on_result, every table is handed to on_result(label, phot_table, image_path) as soon as its image
+    # is finished (in the order they finish) instead of being kept, and the merged table comes back empty.
+    tables = []
+    timings = Table(names=('label', 'seconds', 'n_sources'), dtype=('U64', 'f8', 'i8'))
+    paths = {label: image_path for image_path, label in image_paths}
+
+    def collect(label, phot_table, seconds, metrics_rows):
+        Metrics.merge(metrics_rows)
+        if phot_table is not None:
+            if on_result is None:
+                phot_table.add_column(label, name='label', index=0)
+                tables.append(phot_table)
+            else:
+                on_result(label, phot_table, paths[label])
+        timings.add_row((label, seconds, 0 if phot_table is None else len(phot_table)))
+
+    if workers == 1:
+        for image_path, label in image_paths:
+            collect(*timed_measure_image(image_path, label, radii_factors))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(timed_measure_image, image_path, label, radii_factors, Metrics.is_enabled())
+                       for image_path, label in image_paths]
+            for future in (futures if on_result is None else as_completed(futures)):
+                collect(*future.result())
+    results = vstack(tables, metadata_conflicts='silent') if tables else Table()
+    return results, timings
+
+def write_catalogue(image_paths, catalogue_path, workers=None, radii_factors=DEFAULT_RADII_FACTORS, metadata=None):
+    # Measure every image and append its table to a new photometry catalogue as soon as it is finished.
+    # Returns the catalogue and the timings table.
+    run_metadata = {'RADII': (' '.join(str(factor) for factor in radii_factors), 'aperture radii in units of the FWHM'),
+                    'NIMAGES': (len(image_paths), 'images submitted')}
+    run_metadata.update(metadata or {})
+    catalogue = PhotometryCatalogue(catalogue_path, metadata=run_metadata, overwrite=True)
+    _, timings = run_photometry(image_paths, workers=workers, radii_factors=radii_factors, on_result=catalogue.append)
+    return catalogue, timings
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    # Every image's results are appended to one FITS catalogue as they finish (see Photometry_Catalogue.py);
+    # catalogue.table(label) or catalogue.read(band=..., position=..., radius=...) reads them back.
+    catalogue, timings = write_catalogue(reduced_image_paths, "photometry_catalogue.fits")
+    print(f"\nPhotometry of {len(reduced_image_paths)} images took {time.perf_counter() - start:.1f} s")
+    print(timings)
+
+    # Display a summary per image rather than every source
+    print(catalogue.images())
+    print(f"Saved photometry results to {catalogue.path}")
@@ -0,0 +1,181 @@
+import os
+import numpy as np
+from datetime import datetime
+from astropy.io import fits
+from astropy.table import Table, vstack
+
+# Append-only photometry catalogue in one FITS file. The primary header carries the run metadata and every
+# measured image is appended as its own binary table extension (EXTNAME = label) as soon as it is finished,
+# with the image's object, band, observation, FWHM, aperture and airmass in the extension header. Nothing is
+# rewritten on append, so a long run keeps only the current image's table in memory, and a catalogue
+# interrupted half way still holds every image measured so far.
+#
+# Queries read the extension headers to pick the images by label, object or band and then only the
+# columns and rows they need, through a memory map:
+#   catalogue = PhotometryCatalogue('photometry_catalogue.fits')
+#   catalogue.images()                                    one row per image, from the headers only
+#   catalogue.read(band='B', position=(512, 300), radius=20)
+# An image appended twice (a rerun of one label) is read from its latest extension.
+
+BANDS = ['U', 'B', 'V', 'R', 'I']
+
+# Table meta -> extension header keyword
+_META_KEYWORDS = {'fwhm': 'FWHM', 'aperture_radius': 'APRADIUS', 'aperture_correction': 'APCORR', 'airmass': 'AIRMASS'}
+
+# Copied from the measured image's header
+_IMAGE_KEYWORDS = ['AIRMASS', 'EXPTOTAL', 'DATE-OBS']
+
+
+def label_parts(label):
+    """(object, band, observation) of a label such as 'M52_B' or 'Standard_Star_1_B_1st'."""
+    parts = label.split('_')
+    band_index = max((i for i, part in enumerate(parts) if part in BANDS), default=None)
+    if band_index is None:
+        return label, '', ''
+    return '_'.join(parts[:band_index]), parts[band_index], '_'.join(parts[band_index + 1:])
+
+
+def _image_header(label, phot_table, image_path=None):
+    obj_name, band, observation = label_parts(label)
+    header = fits.Header()
+    header['EXTNAME'] = label
+    header['OBJECT'] = obj_name
+    header['BAND'] = band
+    header['OBSERVTN'] = (observation, 'observation of a standard star, if any')
+    header['NSOURCES'] = len(phot_table)
+    if image_path is not None:
+        header['IMAGE'] = os.path.basename(image_path)
+        if os.path.exists(image_path):
+            image_header = fits.getheader(image_path)
+            for keyword in _IMAGE_KEYWORDS:
+                if keyword in image_header:
+                    header[keyword] = image_header[keyword]
+    header['DATE'] = (datetime.now().isoformat(timespec='seconds'), 'when the image was appended')
+    for key, keyword in _META_KEYWORDS.items():
+        if key in phot_table.meta:
+            header[keyword] = float(phot_table.meta[key])
+    # The curve of growth as indexed keywords: GROWR1.. radii in pixels, GROWC1.. median SNR
+    for i, (radius, snr) in enumerate(zip(phot_table.meta.get('growth_radii', []),
+                                          phot_table.meta.get('growth_curve', [])), start=1):
+        header[f'GROWR{i}'] = float(radius)
+        header[f'GROWC{i}'] = float(snr)
+    return header
+
+
+def _table_meta(header):
+    # Inverse of _image_header for the table meta
+    meta = {key: header[keyword] for key, keyword in _META_KEYWORDS.items() if keyword in header}
+    radii = []
+    curve = []
+    while f'GROWR{len(radii) + 1}' in header:
+        radii.append(header[f'GROWR{len(radii) + 1}'])
+        curve.append(header[f'GROWC{len(curve) + 1}'])
+    if radii:
+        meta['growth_radii'] = radii
+        meta['growth_curve'] = curve
+    return meta
+
+
+class PhotometryCatalogue:
+    def __init__(self, path, metadata=None, overwrite=False):
+        """Open the catalogue at path, creating it if needed.
+
+        metadata (a dict of short keyword -> value, e.g. {'RADII': '3.0'}) goes into the primary header
+        of a new catalogue. With overwrite an existing catalogue is replaced by an empty one.
+        """
+        self.path = path
+        if overwrite or not os.path.exists(path):
+            catalogue_dir = os.path.dirname(path)
+            if catalogue_dir:
+                os.makedirs(catalogue_dir, exist_ok=True)
+            header = fits.Header()
+            header['CREATED'] = datetime.now().isoformat(timespec='seconds')
+            for keyword, value in (metadata or {}).items():
+                header[keyword] = value
+            fits.PrimaryHDU(header=header).writeto(path, overwrite=True)
+
+    def append(self, label, phot_table, image_path=None):
+        """Append the photometry table of one image. Only the new extension is written."""
+        hdu = fits.table_to_hdu(Table(phot_table, meta={}))
+        hdu.header.update(_image_header(label, phot_table, image_path))
+        with fits.open(self.path, mode='append') as hdul:
+            hdul.append(hdu)
+
+    def metadata(self):
+        """The primary header: run metadata."""
+        return fits.getheader(self.path, 0)
+
+    def _extensions(self, hdul, label=None, obj_name=None, band=None):
+        # Latest extension index of every label that matches, in first-appended order
+        latest = {}
+        for index, hdu in enumerate(hdul[1:], start=1):
+            header = hdu.header
+            if label is not None and header['EXTNAME'] != label:
+                continue
+            if obj_name is not None and header.get('OBJECT') != obj_name:
+                continue
+            if band is not None and header.get('BAND') != band:
+                continue
+            latest[header['EXTNAME']] = index
+        return latest
+
+    def labels(self):
+        with fits.open(self.path) as hdul:
+            return list(self._extensions(hdul))
+
+    def images(self):
+        """One row per image (label, object, band, observation, n_sources, fwhm, aperture_radius, airmass),
+        read from the extension headers without touching the tables."""
+        rows = []
+        with fits.open(self.path) as hdul:
+            for label, index in self._extensions(hdul).items():
+                header = hdul[index].header
+                rows.append((label, header.get('OBJECT', ''), header.get('BAND', ''), header.get('OBSERVTN', ''),
+                             header.get('NSOURCES', 0), header.get('FWHM', np.nan), header.get('APRADIUS', np.nan),
+                             header.get('AIRMASS', np.nan)))
+        return Table(rows=rows or None, names=('label', 'object', 'band', 'observation', 'n_sources', 'fwhm',
+                                               'aperture_radius', 'airmass'),
+                     dtype=('U64', 'U64', 'U8', 'U16', 'i8', 'f8', 'f8', 'f8'))
+
+    def table(self, label):
+        """The photometry table of one image with its meta, or None if the label isn't in the catalogue."""
+        if label not in self.labels():
+            return None
+        return self.read(label=label, with_label=False)
+
+    def read(self, label=None, obj_name=None, band=None, position=None, radius=None, box=None, columns=None,
+             with_label=True):
+        """Sources of the images matching label / obj_name / band, as one table.
+
+        position=(x, y) with radius keeps the sources within radius pixels of that point; box=(xmin, xmax,
+        ymin, ymax) keeps the sources inside the box. columns limits the columns read. Unless with_label is
+        False, 'label' and 'band' columns say which image every row came from.
+        """
+        tables = []
+        with fits.open(self.path, memmap=True) as hdul:
+            for name, index in self._extensions(hdul, label, obj_name, band).items():
+                hdu = hdul[index]
+                data = hdu.data
+                if data is None or len(data) == 0:
+                    continue
+                # Only the position columns are read to select the rows
+                keep = np.ones(len(data), dtype=bool)
+                if position is not None:
+                    x, y = data['xcenter'], data['ycenter']
+                    keep &= (x - position[0]) ** 2 + (y - position[1]) ** 2 <= radius ** 2
+                if box is not None:
+                    x, y = data['xcenter'], data['ycenter']
+                    keep &= (x >= box[0]) & (x <= box[1]) & (y >= box[2]) & (y <= box[3])
+                rows = np.flatnonzero(keep)
+                names = columns or data.names
+                selected = Table({column: np.array(data[column][rows]) for column in names},
+                                 meta=_table_meta(hdu.header))
+                if with_label:
+                    selected.add_column(name, name='label', index=0)
+                    selected.add_column(hdu.header.get('BAND', ''), name='band', index=1)
+                tables.append(selected)
+        if not tables:
+            return Table()
+        if len(tables) == 1:
+            return tables[0]
+        return vstack(tables, metadata_conflicts='silent')
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+
+# One entry point for the whole reduction:
+#   ingest -> bias -> dark, flats -> reduce -> align_stack -> photometry -> match -> calibrate.
+# Stages run in dependency order and each one streams its frames from disk (memory-mapped views from the
+# catalogue, tile-wise combines, one calibrated frame at a time), so no stage holds a whole object in memory.
+# After every stage a JSON checkpoint records what finished and what it wrote; a rerun skips stages that
+# are checkpointed and whose outputs still exist, so an interrupted night resumes where it stopped.
+#
+# Usage:
+#   python Pipeline.py                      run (or resume) everything
+#   python Pipeline.py photometry           run photometry and whatever it still needs
+#   python Pipeline.py --force flats        rebuild the flats and everything downstream of them
+#   python Pipeline.py --restart            ignore the checkpoint
+#   python Pipeline.py --metrics run.json   also write per-stage timings, MB/s and peak memory (see Metrics.py)
+
+import Metrics
+from Main import catalogue, reduction_dir, master_bias_path, master_dark_path, master_flat_path, flat_bands, bands, observations
+
+checkpoint_path = os.path.join(reduction_dir, 'pipeline_checkpoint.json')
+header_index_path = os.path.join(reduction_dir, 'header_index.sqlite')
+photometry_dir = os.path.join(reduction_dir, 'Photometry')
+photometry_catalogue_path = os.path.join(photometry_dir, 'photometry_catalogue.fits')
+standard_stars_path = os.path.join(reduction_dir, 'standard_stars.ecsv')  # catalogue magnitudes of the standards
+zero_points_path = os.path.join(photometry_dir, 'zero_points.ecsv')
+
+OBSERVATION_LABELS = {'First observation': '1st', 'Second observation': '2nd', 'Third observation': '3rd'}
+
+
+# --- Stages ---
+# Each stage takes the parsed options and returns the list of paths it wrote. The stage modules are only
+# imported when the stage runs, so resuming at photometry never touches the raw frames.
+
+def run_ingest(options):
+    # Scan every header once; later stages select frames from this in-process index. The persistent
+    # header index is this stage's output, refreshed for new or changed files only
+    from Header_Index import HeaderIndex
+    frames = catalogue.index()
+    print(f"Indexed {len(frames)} frames below {catalogue.base_dir}")
+    index = HeaderIndex(header_index_path)
+    try:
+        index.refresh(catalogue.base_dir)
+    finally:
+        index.close()
+    return [header_index_path]
+
+def run_bias(options):
+    from Bias_Master import build_master_bias
+    build_master_bias(method=options.bias_method, show_plot=False)
+    return [master_bias_path]
+
+def run_dark(options):
+    from Dark_Master import build_master_dark
+    master_dark = build_master_dark(method=options.dark_method, show_plot=False)
+    return [] if master_dark is None else [master_dark_path]
+
+def run_flats(options):
+    from Flat_Master_Normalised_flat_Creator_OD import create_and_plot_master_flats
+    create_and_plot_master_flats(method=options.flat_method, show_plot=False)
+    return [master_flat_path(band) for band in flat_bands]
+
+def run_reduce(options):
+    from Data_Reduction import load_master_bias, load_master_dark, load_master_flats, reduce_fits_data, reduced_image_dir
+    master_bias = load_master_bias()
+    if master_bias is None:
+        raise FileNotFoundError(f"Master bias {master_bias_path} could not be loaded")
+    master_dark = load_master_dark() if catalogue.select('Dark') else None
+    reduce_fits_data(master_bias, load_master_flats(), backend=options.backend, storage=options.storage,
+                     precision=options.precision, master_dark=master_dark)
+    return [reduced_image_dir]
+
+def run_align_stack(options):
+    from Align_Stack import stack_all
+    return stack_all(method=options.stack_method, workers=options.workers or 1, storage=options.storage)
+
+def stacked_image_paths():
+    """(path, label) of every stacked image, in the order and with the labels NewAperturePhotometry.py uses."""
+    from Align_Stack import stack_output_path
+    image_paths = []
+    for obj_name in ['M52', 'NGC7789']:
+        for band in bands:
+            image_paths.append((stack_output_path(obj_name, band), f"{obj_name}_{band[0]}"))
+    for obj_name in ['Standard Star 1', 'Standard Star 2']:
+        for band in bands:
+            for observation in observations:
+                label = f"{obj_name.replace(' ', '_')}_{band[0]}_{OBSERVATION_LABELS[observation]}"
+                image_paths.append((stack_output_path(obj_name, band, observation), label))
+    return [(path, label) for path, label in image_paths if os.path.exists(path)]
+
+def run_photometry(options):
+    from NewAperturePhotometry import write_catalogue
+    catalogue, timings = write_catalogue(stacked_image_paths(), photometry_catalogue_path, workers=options.workers,
+                                         metadata={'STACKMTH': options.stack_method})
+    print(timings)
+    print(f"Saved photometry of {len(catalogue.labels())} images to {catalogue.path}")
+    return [catalogue.path]
+
+def matched_catalogue_path(obj_name):
+    return os.path.join(photometry_dir, f"{obj_name}_UBV_matched.fits")
+
+def run_match(options):
+    # Merged U/B/V catalogues of the clusters, for the colour-magnitude diagrams
+    from Align_Stack import stack_output_path
+    from Cross_Match import match_object
+    from Photometry_Catalogue import PhotometryCatalogue
+    photometry = PhotometryCatalogue(photometry_catalogue_path)
+    outputs = []
+    for obj_name in ['M52', 'NGC7789']:
+        band_images = {band[0]: stack_output_path(obj_name, band) for band in bands}
+        merged = match_object(photometry, obj_name, band_images, max_separation=options.match_radius)
+        if merged is None:
+            continue
+        merged.write(matched_catalogue_path(obj_name), overwrite=True)
+        outputs.append(matched_catalogue_path(obj_name))
+    return outputs
+
+def calibrated_catalogue_path(obj_name):
+    return os.path.join(photometry_dir, f"{obj_name}_UBV_calibrated.fits")
+
+def run_calibrate(options):
+    # Zero points and extinction from the standard stars, applied to the matched cluster catalogues
+    from astropy.table import Table
+    from Photometry_Catalogue import PhotometryCatalogue
+    from Standard_Calibration import load_standard_magnitudes, standard_measurements, fit_zero_points, calibrate_matched
+    if not os.path.exists(options.standards):
+        print(f"No standard star magnitudes at {options.standards}, skipping the calibration "
+              "(add the file and rerun with --force calibrate).")
+        return []
+    measurements = standard_measurements(PhotometryCatalogue(photometry_catalogue_path),
+                                         load_standard_magnitudes(options.standards))
+    if len(measurements) == 0:
+        print("None of the standard stars were found in the photometry, skipping the calibration.")
+        return []
+    solution = fit_zero_points(measurements)
+    print(solution)
+    solution.write(zero_points_path, format='ascii.ecsv', overwrite=True)
+    outputs = [zero_points_path]
+    for obj_name in ['M52', 'NGC7789']:
+        if not os.path.exists(matched_catalogue_path(obj_name)):
+            continue
+        calibrated = calibrate_matched(Table.read(matched_catalogue_path(obj_name)), solution)
+        calibrated.write(calibrated_catalogue_path(obj_name), overwrite=True)
+        outputs.append(calibrated_catalogue_path(obj_name))
+    return outputs
+
+
+# Stage name -> (stages it depends on, function). Listed in a valid run order.
+STAGES = {
+    'ingest': ([], run_ingest),
+    'bias': (['ingest'], run_bias),
+    'dark': (['ingest', 'bias'], run_dark),
+    'flats': (['ingest', 'bias'], run_flats),
+    'reduce': (['ingest', 'bias', 'dark', 'flats'], run_reduce),
+    'align_stack': (['reduce'], run_align_stack),
+    'photometry': (['align_stack'], run_photometry),
+    'match': (['photometry'], run_match),
+    'calibrate': (['photometry', 'match'], run_calibrate),
+}
+
+
+def required_stages(targets):
+    """The targets and everything they depend on, in run order."""
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(STAGES[name][0])
+    return [name for name in STAGES if name in needed]
+
+def downstream_stages(names):
+    """The given stages and everything that depends on them."""
+    affected = set(names)
+    for name, (dependencies, _) in STAGES.items():
+        if affected.intersection(dependencies):
+            affected.add(name)
+    return affected
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return {}
+
+def save_checkpoint(path, checkpoint):
+    # Written to a temporary file and renamed, so an interrupted write never leaves half a checkpoint
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(temporary_path, path)
+
+def is_complete(checkpoint, name):
+    """Checkpointed, outputs still on disk, and finished after every stage it depends on."""
+    entry = checkpoint.get(name)
+    if entry is None or not all(os.path.exists(path) for path in entry['outputs']):
+        return False
+    # 'sequence' counts finished stages, so a dependency rerun in an earlier, partial run is still noticed
+    return all(dependency in checkpoint and checkpoint[dependency]['sequence'] < entry['sequence']
+               for dependency in STAGES[name][0])
+
+
+def run_pipeline(targets=None, force=(), restart=False, options=None, checkpoint_file=checkpoint_path):
+    """Run the target stages (default: all) and their dependencies, resuming from the checkpoint."""
+    options = options or parse_args([])
+    targets = targets or list(STAGES)
+    checkpoint = {} if restart else load_checkpoint(checkpoint_file)
+    rerun = downstream_stages(force)
+
+    for name in required_stages(targets):
+        stage = STAGES[name][1]
+        if name not in rerun and is_complete(checkpoint, name):
+            print(f"[{name}] done at {checkpoint[name]['completed']}, skipping")
+            continue
+
+        print(f"[{name}] running")
+        start = time.perf_counter()
+        with Metrics.timer(f'stage.{name}'):
+            outputs = stage(options)
+        seconds = time.perf_counter() - start
+        sequence = max([entry['sequence'] for entry in checkpoint.values()], default=0) + 1
+        checkpoint[name] = {'completed': datetime.now().isoformat(timespec='seconds'), 'sequence': sequence,
+                            'seconds': round(seconds, 3), 'outputs': outputs}
+        save_checkpoint(checkpoint_file, checkpoint)
+        print(f"[{name}] finished in {seconds:.1f} s")
+    return checkpoint
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the TGP reduction pipeline")
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f"stages to run, from {', '.join(STAGES)} (their dependencies are run first "
+                             "if needed); default is all")
+    parser.add_argument('--force', nargs='+', default=[], choices=list(STAGES),
+                        help="rerun these stages and everything downstream even if checkpointed")
+    parser.add_argument('--restart', action='store_true', help="ignore the existing checkpoint")
+    parser.add_argument('--checkpoint', default=checkpoint_path, help="checkpoint file")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes/threads (default: every core)")
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'numexpr'], help="calibration backend")
+    parser.add_argument('--storage', default='fits', choices=['fits', 'rice', 'hcompress', 'npy'],
+                        help="file format of the reduced frames (see Intermediate_Storage.py)")
+    parser.add_argument('--precision', default='float32', choices=['float32', 'float16'], help="precision of 'npy' storage")
+    parser.add_argument('--bias-method', default='mean', help="combine method of the master bias")
+    parser.add_argument('--dark-method', default='sigma_clip', help="combine method of the master dark")
+    parser.add_argument('--flat-method', default='mean', help="combine method of the master flats")
+    parser.add_argument('--stack-method', default='median', help="combine method of the science stacks")
+    parser.add_argument('--match-radius', type=float, default=2.0, help="cross-band match radius in pixels")
+    parser.add_argument('--standards', default=standard_stars_path,
+                        help="table of the standard stars' catalogue magnitudes (columns star, band, mag[, x, y])")
+    parser.add_argument('--metrics', default=None, help="write a metrics report here (.json or .csv)")
+    parser.add_argument('--profile', default=None, help="write a cProfile dump here (needs --metrics)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s) {', '.join(unknown)}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.metrics:
+        Metrics.enable(profile_path=args.profile)
+    run_pipeline(args.stages, force=args.force, restart=args.restart, options=args, checkpoint_file=args.checkpoint)
+    if args.metrics:
+        Metrics.write_report(args.metrics)
+        Metrics.disable()
@@ -0,0 +1,159 @@
+import numpy as np
+from astropy.table import Table
+from Cross_Match import magnitude_column
+
+# Zero points and atmospheric extinction from the standard-star observations, and their application to the
+# cluster catalogues. Every standard-star stack gives one equation
+#     m_standard - m_instrumental = ZP_band - k_band * X
+# with X the mean airmass of the stack (Align_Stack.py writes it into the stacked header and the photometry
+# catalogue copies it into each image's extension). All bands are solved together as one weighted linear
+# least-squares problem with a block-diagonal design matrix (one [1, -X] block per band), so the zero points,
+# extinction coefficients and their covariance come out of a single lstsq call. Calibrating a catalogue is
+# then one vectorized expression per band.
+#
+# The catalogue magnitudes of the standards are not in the data, so they come from a small table (ECSV or
+# CSV) with columns star (the photometry label prefix, e.g. Standard_Star_1), band and mag, and optionally
+# x and y: the star's position in its stacks. Without a position the brightest source of the stack is used.
+# The standards are measured in the same magnitude column as the matched catalogues (Cross_Match's
+# magnitude_column: total_mag when the photometry has an aperture correction), so the zero points apply.
+
+MIN_MAG_ERROR = 0.01  # floor on the weights, so a few very bright measurements don't dominate the fit
+
+
+def load_standard_magnitudes(path):
+    standards = Table.read(path, format='ascii.ecsv' if path.endswith('.ecsv') else 'ascii.csv')
+    for column in ['star', 'band', 'mag']:
+        if column not in standards.colnames:
+            raise ValueError(f"Standard star table {path} has no '{column}' column")
+    return standards
+
+
+def standard_measurements(catalogue, standards, search_radius=10.0):
+    """One row per standard-star image: star, band, label, airmass, instrumental mag, its error, the
+    catalogue magnitude and the photometry column the instrumental mag was read from (see
+    Cross_Match.magnitude_column). Reads only the standard stars' extensions of the PhotometryCatalogue."""
+    known = {(str(row['star']), str(row['band'])): row for row in standards}
+    has_position = 'x' in standards.colnames and 'y' in standards.colnames
+    rows = []
+    for image in catalogue.images():
+        standard = known.get((image['object'], image['band']))
+        if standard is None:
+            continue
+        if not np.isfinite(image['airmass']):
+            print(f"{image['label']} has no AIRMASS, left out of the extinction fit.")
+            continue
+        if has_position and np.isfinite(standard['x']) and np.isfinite(standard['y']):
+            sources = catalogue.read(label=image['label'], position=(standard['x'], standard['y']),
+                                     radius=search_radius, with_label=False)
+            if len(sources) == 0:
+                print(f"No source within {search_radius} pixels of {standard['star']} in {image['label']}.")
+                continue
+            best = np.argmin(np.hypot(sources['xcenter'] - standard['x'], sources['ycenter'] - standard['y']))
+        else:
+            sources = catalogue.read(label=image['label'], with_label=False)
+            if len(sources) == 0:
+                continue
+            best = np.argmin(sources[magnitude_column(sources)])
+        column = magnitude_column(sources)
+        rows.append((standard['star'], image['band'], image['label'], image['airmass'],
+                     sources[column][best], sources['mag_error'][best], standard['mag'], column))
+    return Table(rows=rows or None, names=('star', 'band', 'label', 'airmass', 'instrumental_mag', 'mag_error',
+                                           'standard_mag', 'mag_column'),
+                 dtype=('U64', 'U8', 'U64', 'f8', 'f8', 'f8', 'f8', 'U16'))
+
+
+def fit_zero_points(measurements, bands=None):
+    """Zero point and extinction coefficient of every band, fitted together by weighted least squares.
+
+    Returns a table with band, zero_point, zero_point_error, extinction, extinction_error, n_obs and the
+    rms of the residuals. A band observed at a single airmass can't separate the two, so its extinction is
+    fixed at 0 and only the zero point is fitted. The MAGCOL_<band> meta records the magnitude column the
+    band's standards were measured in.
+    """
+    bands = list(bands or sorted(set(measurements['band'])))
+    band_index = np.array([bands.index(band) for band in measurements['band']])
+    airmass = np.asarray(measurements['airmass'], dtype=float)
+    y = np.asarray(measurements['standard_mag'] - measurements['instrumental_mag'], dtype=float)
+    weights = 1.0 / np.maximum(np.asarray(measurements['mag_error'], dtype=float), MIN_MAG_ERROR)
+
+    # Block-diagonal design matrix: columns 2j and 2j+1 are band j's zero point and extinction
+    n_obs = np.bincount(band_index, minlength=len(bands))
+    airmass_range = np.array([np.ptp(airmass[band_index == j]) if n_obs[j] else 0.0 for j in range(len(bands))])
+    fit_extinction = airmass_range > 1e-3
+    design = np.zeros((len(y), 2 * len(bands)))
+    rows = np.arange(len(y))
+    design[rows, 2 * band_index] = 1.0
+    design[rows, 2 * band_index + 1] = np.where(fit_extinction[band_index], -airmass, 0.0)
+    free = np.zeros(2 * len(bands), dtype=bool)
+    free[0::2] = n_obs > 0
+    free[1::2] = fit_extinction
+    free = np.flatnonzero(free)
+
+    weighted = design[:, free] * weights[:, None]
+    parameters = np.zeros(2 * len(bands))
+    errors = np.full(2 * len(bands), np.nan)
+    solution, _, _, _ = np.linalg.lstsq(weighted, y * weights, rcond=None)
+    parameters[free] = solution
+    residuals = y - design @ parameters
+
+    # Covariance scaled by the reduced chi-square when there are spare degrees of freedom
+    dof = len(y) - len(free)
+    covariance = np.linalg.pinv(weighted.T @ weighted)
+    if dof > 0:
+        covariance *= np.sum((residuals * weights) ** 2) / dof
+    errors[free] = np.sqrt(np.diag(covariance))
+
+    rms = np.array([np.sqrt(np.mean(residuals[band_index == j] ** 2)) if n_obs[j] else np.nan
+                    for j in range(len(bands))])
+    for band, n, fitted in zip(bands, n_obs, fit_extinction):
+        if n and not fitted:
+            print(f"{band}-band standards were all observed at the same airmass, its extinction is fixed at 0.")
+    solution = Table({'band': bands, 'zero_point': parameters[0::2], 'zero_point_error': errors[0::2],
+                      'extinction': parameters[1::2], 'extinction_error': errors[1::2], 'n_obs': n_obs, 'rms': rms})
+    if 'mag_column' in measurements.colnames:
+        for j, band in enumerate(bands):
+            columns = sorted(set(measurements['mag_column'][band_index == j]))
+            if len(columns) > 1:
+                print(f"{band}-band standards mix the {' and '.join(columns)} columns, their zero point is off by "
+                      f"the aperture correction.")
+            if columns:
+                solution.meta[f'MAGCOL_{band}'] = columns[-1]
+    return solution
+
+
+def calibrate_magnitudes(magnitudes, band, airmass, solution):
+    """Standard magnitudes of a whole column of instrumental magnitudes observed in band at airmass."""
+    row = solution[list(solution['band']).index(band)]
+    return np.asanyarray(magnitudes) + row['zero_point'] - row['extinction'] * airmass  # masks are kept
+
+
+def calibrate_matched(merged, solution):
+    """Add std_<band> standard magnitudes of every fitted band, and the std_B-V and std_U-B colours, to a
+    Cross_Match merged table.
+
+    The airmass of every band comes from the table's AIRM_<band> meta. A band whose magnitudes come from
+    another column (Cross_Match.magnitude_column, MAGCOL_<band>) than its standards' is left uncalibrated.
+    """
+    calibrated = merged.copy(copy_data=False)
+    for band in solution['band']:
+        if f'mag_{band}' not in merged.colnames:
+            continue
+        airmass = merged.meta.get(f'AIRM_{band}')
+        if airmass is None:
+            print(f"No airmass for the {band}-band image of {merged.meta.get('OBJECT', 'this catalogue')}, "
+                  f"{band} left uncalibrated.")
+            continue
+        fitted_column = solution.meta.get(f'MAGCOL_{band}')
+        matched_column = merged.meta.get(f'MAGCOL_{band}')
+        if fitted_column and matched_column and fitted_column != matched_column:
+            print(f"The {band}-band zero point was fitted to {fitted_column} but the catalogue has {matched_column}, "
+                  f"{band} left uncalibrated.")
+            continue
+        calibrated[f'std_{band}'] = calibrate_magnitudes(merged[f'mag_{band}'], band, airmass, solution)
+    for blue, red in [('B', 'V'), ('U', 'B')]:
+        if f'std_{blue}' in calibrated.colnames and f'std_{red}' in calibrated.colnames:
+            calibrated[f'std_{blue}-{red}'] = calibrated[f'std_{blue}'] - calibrated[f'std_{red}']
+    for row in solution:
+        calibrated.meta[f'ZP_{row["band"]}'] = float(row['zero_point'])
+        calibrated.meta[f'K_{row["band"]}'] = float(row['extinction'])
+    return calibrated
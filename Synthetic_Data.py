@@ -0,0 +1,162 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+# Deterministic synthetic night for benchmarks and for trying the pipeline without the observation data:
+# bias frames with read noise and a fixed column pattern, darks with hot pixels, flats with vignetting,
+# and star fields with Gaussian PSFs, all written as uint16 FITS files in the folder layout described in README.md.
+# The same seed always gives the same files.
+
+DETECTOR_SHAPE = (4096, 4096)
+BIAS_LEVEL = 1000.0
+READ_NOISE = 5.0  # ADU
+
+
+def column_pattern(shape, rng, amplitude=2.0):
+    # Fixed column-to-column offset shared by every frame of the night, so the master bias has structure to remove
+    return rng.normal(0.0, amplitude, shape[1]).astype(np.float32)
+
+
+def vignetting(shape, strength=0.3):
+    """Relative illumination, 1 at the centre falling to 1 - strength in the corners."""
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    r2 = ((y - shape[0] / 2) / (shape[0] / 2)) ** 2 + ((x - shape[1] / 2) / (shape[1] / 2)) ** 2
+    return (1.0 - strength * r2 / 2.0).astype(np.float32)
+
+
+def to_uint16(image):
+    return np.clip(np.round(image), 0, 65535).astype(np.uint16)
+
+
+def bias_frame(shape, rng, pattern, level=BIAS_LEVEL, read_noise=READ_NOISE):
+    return to_uint16(level + pattern + rng.normal(0.0, read_noise, shape).astype(np.float32))
+
+
+def flat_frame(shape, rng, pattern, illumination, level=20000.0):
+    signal = level * illumination
+    return to_uint16(BIAS_LEVEL + pattern + rng.poisson(signal).astype(np.float32) +
+                     rng.normal(0.0, READ_NOISE, shape).astype(np.float32))
+
+
+def star_positions(shape, rng, n_stars, border=20, flux_range=(1e3, 1e5)):
+    """(x, y, flux) of n_stars stars, uniform on the frame and log-uniform in flux."""
+    x = rng.uniform(border, shape[1] - border, n_stars)
+    y = rng.uniform(border, shape[0] - border, n_stars)
+    flux = 10 ** rng.uniform(np.log10(flux_range[0]), np.log10(flux_range[1]), n_stars)
+    return x, y, flux
+
+
+def star_field(shape, x, y, flux, fwhm=4.0, sky=200.0):
+    """Noise-free sky + Gaussian stars. Each star is only evaluated in a +-4 sigma stamp around it."""
+    image = np.full(shape, sky, dtype=np.float32)
+    sigma = fwhm / 2.3548
+    half = int(np.ceil(4 * sigma))
+    offsets = np.arange(-half, half + 1)
+    for xc, yc, f in zip(x, y, flux):
+        x0, y0 = int(round(xc)), int(round(yc))
+        xs = x0 + offsets
+        ys = y0 + offsets
+        xs = xs[(xs >= 0) & (xs < shape[1])]
+        ys = ys[(ys >= 0) & (ys < shape[0])]
+        profile_x = np.exp(-(xs - xc) ** 2 / (2 * sigma ** 2))
+        profile_y = np.exp(-(ys - yc) ** 2 / (2 * sigma ** 2))
+        image[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1] += f / (2 * np.pi * sigma ** 2) * np.outer(profile_y, profile_x)
+    return image
+
+
+def dark_current_map(shape, rng, dark_current, hot_fraction=1e-3, hot_factor=50.0):
+    """Dark current in ADU/s per pixel: uniform, plus a fraction of hot pixels hot_factor times brighter."""
+    dark = np.full(shape, dark_current, dtype=np.float32)
+    hot = rng.random(shape) < hot_fraction
+    dark[hot] *= hot_factor
+    return dark
+
+
+def dark_frame(shape, rng, pattern, dark, exptime):
+    return to_uint16(BIAS_LEVEL + pattern + rng.poisson(dark * exptime).astype(np.float32) +
+                     rng.normal(0.0, READ_NOISE, shape).astype(np.float32))
+
+
+def science_frame(shape, rng, pattern, illumination, x, y, flux, fwhm=4.0, sky=200.0, dark=None, exptime=30.0):
+    signal = star_field(shape, x, y, flux, fwhm, sky) * illumination
+    if dark is not None:
+        signal += dark * exptime
+    return to_uint16(BIAS_LEVEL + pattern + rng.poisson(signal).astype(np.float32) +
+                     rng.normal(0.0, READ_NOISE, shape).astype(np.float32))
+
+
+def write_frame(path, data, **keywords):
+    header = fits.Header()
+    for keyword, value in keywords.items():
+        header[keyword] = value
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fits.PrimaryHDU(data, header=header).writeto(path, overwrite=True)
+
+
+def write_night(base_dir, shape=DETECTOR_SHAPE, n_bias=10, n_flats=5, n_science=5, star_density=200.0,
+                fwhm=4.0, objects=('M52',), bands=('B-band', 'U-band', 'V-band'), seed=0,
+                n_darks=0, dark_current=0.0, dark_exptime=300.0):
+    """Write a synthetic night below base_dir and return the list of files written.
+
+    star_density is the number of stars per million pixels. Science frames of an object share its star
+    list and are dithered by a few pixels, so they can be aligned and stacked. With dark_current (ADU/s)
+    the science frames collect dark current and n_darks darks of dark_exptime seconds are written.
+    """
+    rng = np.random.default_rng(seed)
+    pattern = column_pattern(shape, rng)
+    illumination = vignetting(shape)
+    written = []
+
+    # The darks draw from their own generator, so the other frames don't change when darks are added
+    dark = None
+    if dark_current:
+        dark_rng = np.random.default_rng(seed + 1)
+        dark = dark_current_map(shape, dark_rng, dark_current)
+        for i in range(n_darks):
+            path = os.path.join(base_dir, 'Calibration', 'Dark', f'dark_{i:03d}.fits')
+            write_frame(path, dark_frame(shape, dark_rng, pattern, dark, dark_exptime), IMAGETYP='Dark', EXPTIME=dark_exptime)
+            written.append(path)
+
+    for i in range(n_bias):
+        path = os.path.join(base_dir, 'Calibration', 'Bias', f'bias_{i:03d}.fits')
+        write_frame(path, bias_frame(shape, rng, pattern), IMAGETYP='Bias', EXPTIME=0.0)
+        written.append(path)
+
+    for band in bands:
+        flat_band = band.replace('band', 'Band')  # the flat folders are named B-Band, U-Band, V-Band
+        for i in range(n_flats):
+            path = os.path.join(base_dir, 'Calibration', 'Flats', flat_band, f'flat_{band[0]}_{i:03d}.fits')
+            write_frame(path, flat_frame(shape, rng, pattern, illumination), IMAGETYP='Flat', FILTER=band[0], EXPTIME=2.0)
+            written.append(path)
+
+    n_stars = int(star_density * shape[0] * shape[1] / 1e6)
+    for obj_name in objects:
+        x, y, flux = star_positions(shape, rng, n_stars)
+        for band in bands:
+            for i in range(n_science):
+                dx, dy = rng.uniform(-5, 5, 2)
+                path = os.path.join(base_dir, obj_name, band, f'{obj_name}_{band[0]}_{i:03d}.fits')
+                data = science_frame(shape, rng, pattern, illumination, x + dx, y + dy, flux, fwhm, dark=dark)
+                write_frame(path, data, IMAGETYP='Light', OBJECT=obj_name, FILTER=band[0], EXPTIME=30.0,
+                            AIRMASS=1.2 + 0.01 * i)
+                written.append(path)
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic night in the observation_data layout")
+    parser.add_argument('base_dir')
+    parser.add_argument('--size', type=int, default=DETECTOR_SHAPE[0], help="frame size in pixels (square)")
+    parser.add_argument('--bias', type=int, default=10)
+    parser.add_argument('--flats', type=int, default=5)
+    parser.add_argument('--science', type=int, default=5)
+    parser.add_argument('--darks', type=int, default=0)
+    parser.add_argument('--dark-current', type=float, default=0.0, help="dark current in ADU/s")
+    parser.add_argument('--density', type=float, default=200.0, help="stars per million pixels")
+    parser.add_argument('--fwhm', type=float, default=4.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    files = write_night(args.base_dir, (args.size, args.size), args.bias, args.flats, args.science,
+                        args.density, args.fwhm, seed=args.seed, n_darks=args.darks, dark_current=args.dark_current)
+    print(f"Wrote {len(files)} frames to {args.base_dir}")
@@ -1,11 +1,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
 from astropy.visualization import SqrtStretch, ImageNormalize, ZScaleInterval
 from photutils.aperture import CircularAperture, CircularAnnulus, aperture_photometry
 from photutils.detection import DAOStarFinder
 from astropy.convolution import Gaussian2DKernel, convolve
+from Background_Mesh import background_maps
 import os
 from matplotlib.colors import LogNorm
 
@@ -26,14 +26,15 @@ for reduced_image_path in reduced_image_paths:
             kernel = Gaussian2DKernel(x_stddev=1.5)
             data_smooth = convolve(data, kernel)
 
-            # Estimate background noise statistics
-            mean, median, std = sigma_clipped_stats(data_smooth, sigma=3.0)
+            # Local background and noise maps, so detection follows sky gradients
+            background, rms = background_maps(data_smooth)
 
-            # Find stars using DAOStarFinder with adjusted parameters
+            # Find stars using DAOStarFinder with adjusted parameters, at 5 x the local RMS (on the S/N image,
+            # as DAOStarFinder takes a single threshold)
             
-            daofind = DAOStarFinder(fwhm=3.5, threshold=5.0*std, sharplo=0.4, sharphi=1.2, roundlo=-0.8, roundhi=0.8)
+            daofind = DAOStarFinder(fwhm=3.5, threshold=5.0, sharplo=0.4, sharphi=1.2, roundlo=-0.8, roundhi=0.8)
 
-            sources = daofind(data_smooth - median)
+            sources = daofind(np.divide(data_smooth - background, rms, out=np.zeros_like(data_smooth), where=rms > 0))
 
             if sources is None or len(sources) == 0:
                 print(f"No sources found in {reduced_image_path}")
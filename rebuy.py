@@ -1,21 +1,61 @@
 import os
+from functools import lru_cache
 from astropy.io import fits
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.visualization import ZScaleInterval
+from Frame_Catalogue import open_frame
+from Frame_Combine import combine_frames, DiskStack, DEFAULT_MAX_MEMORY
+from Header_Index import HeaderIndex
+from Intermediate_Storage import write_frame
+
+# Master frames as they are used in the reduction (cast, and for flats normalised), shared by every filter and
+# every processor in the process. The file's mtime is part of the key, so a rebuilt master is reloaded.
+@lru_cache(maxsize=16)
+def _cached_master(path, mtime_ns, normalize, dtype_name):
+    with fits.open(path) as hdul:
+        master = np.array(hdul[0].data, dtype=dtype_name)
+    if normalize:
+        master /= np.mean(master, dtype=np.float64)
+    master.setflags(write=False)  # shared between callers, so nobody may change it in place
+    return master
+
+def load_master_frame(path, normalize=False, dtype=np.float32):
+    """Master frame at path cast to dtype (and divided by its mean with normalize), read once and then cached."""
+    return _cached_master(path, os.stat(path).st_mtime_ns, normalize, np.dtype(dtype).name)
+
+REDUCTION_MODES = ['stack_then_reduce', 'reduce_then_stack']
 
 class ScienceFrameProcessor:
-    def __init__(self, base_dir, master_bias_path, master_flats_dir):
+    def __init__(self, base_dir, master_bias_path, master_flats_dir, combine_method='median', workers=None, index_path=None,
+                 storage='fits', dtype=np.float32, mode='stack_then_reduce', max_memory=DEFAULT_MAX_MEMORY, scratch_dir=None,
+                 **storage_options):
+        if mode not in REDUCTION_MODES:
+            raise ValueError(f"Unknown reduction mode '{mode}', expected one of {REDUCTION_MODES}")
         self.base_dir = base_dir
+        # Header index of the tree, kept next to the Reduced_Images output so it survives between runs
+        if index_path is None:
+            index_path = os.path.join(os.path.dirname(self.base_dir), 'header_index.sqlite')
+        self.index = HeaderIndex(index_path)
         self.master_bias_path = master_bias_path
         self.master_flats_dir = master_flats_dir
+        self.combine_method = combine_method  # 'median', 'mean', 'sigma_clip' or 'minmax' (see Frame_Combine)
+        self.workers = workers  # None combines the stack on every core
+        self.dtype = dtype  # working dtype of the stack and the masters
+        # 'stack_then_reduce' combines the raw frames and calibrates the stack once; 'reduce_then_stack' calibrates
+        # every frame first (into a temporary stack on disk, in scratch_dir) and then combines the calibrated frames
+        self.mode = mode
+        self.max_memory = max_memory  # working memory of the tile-wise combine
+        self.scratch_dir = scratch_dir
+        # File format of the reduced images: 'fits' (float32), 'rice'/'hcompress' (tile-compressed) or 'npy' (see Intermediate_Storage)
+        self.storage = storage
+        self.storage_options = storage_options
         self.filters = ['B', 'V', 'R', 'U', 'Halpha', 'OIII', 'SII']
         self.found_files = {filter_name: [] for filter_name in self.filters}
         
-        # Load master bias at initialization
+        # Load master bias at initialization (from the shared master cache)
         try:
-            with fits.open(self.master_bias_path) as hdul:
-                self.master_bias = hdul[0].data
+            self.master_bias = load_master_frame(self.master_bias_path, dtype=self.dtype)
             print(f"Successfully loaded master bias from: {self.master_bias_path}")
         except Exception as e:
             print(f"Error loading master bias: {e}")
@@ -37,41 +77,37 @@ class ScienceFrameProcessor:
             print(f"No science frames found for filter {filter_name}")
             return None, None
 
+        if self.mode == 'reduce_then_stack':
+            return self.reduce_then_stack(filter_name, frame_list)
+
         try:
-            # First stack the raw science frames
+            # First stack the raw science frames (memory-mapped, only read tile by tile by the combine)
+            # The header comes from the same open as the data of the first frame
             stacked_data = []
+            header = None
             for file_path in frame_list:
-                with fits.open(file_path) as hdul:
-                    data = hdul[0].data
-                    if data is not None:
-                        stacked_data.append(data)
+                data, frame_header = open_frame(file_path)
+                if data is not None:
+                    stacked_data.append(data)
+                    if header is None:
+                        header = frame_header
 
             if not stacked_data:
                 print(f"No valid data frames found for filter {filter_name}")
                 return None, None
 
-            # Stack frames by taking the median
-            stacked_frame = np.median(stacked_data, axis=0)
+            # Stack frames by taking the median (or the configured rejection method) over parallel tiles
+            stacked_frame = combine_frames(stacked_data, method=self.combine_method, dtype=self.dtype, workers=self.workers)
             print(f"Stacked {len(stacked_data)} frames for filter {filter_name}")
-            
-            # Get the header from the first file
-            with fits.open(frame_list[0]) as hdul:
-                header = hdul[0].header
 
-            # Apply bias subtraction
+            # Apply bias subtraction (in place, the stack is ours)
             if self.master_bias is None:
                 raise ValueError("Master bias not loaded")
-            bias_subtracted = stacked_frame - self.master_bias
-            
-            # Apply flat field correction
-            with fits.open(self.get_master_flat(filter_name)) as flat_hdul:
-                master_flat = flat_hdul[0].data
-                
-            # Normalize the master flat
-            normalized_flat = master_flat / np.mean(master_flat)
+            stacked_frame -= self.master_bias
             
-            # Perform flat field correction
-            reduced_frame = bias_subtracted / normalized_flat
+            # Apply flat field correction with the normalised master flat, loaded and normalised once per file
+            normalized_flat = load_master_frame(self.get_master_flat(filter_name), normalize=True, dtype=self.dtype)
+            reduced_frame = np.divide(stacked_frame, normalized_flat, out=stacked_frame)
             
             print(f"Successfully reduced frames for filter {filter_name}")
             return reduced_frame, header
@@ -80,6 +116,46 @@ class ScienceFrameProcessor:
             print(f"Error reducing frames for filter {filter_name}: {e}")
             return None, None
 
+    def reduce_then_stack(self, filter_name, frame_list):
+        """Calibrate every frame as it is read, then combine the calibrated frames.
+
+        Each frame is calibrated as (raw - bias) / flat into one reused buffer and written to a DiskStack, and the stack is combined
+        tile by tile with self.combine_method ('median', or 'sigma_clip'/'minmax' for rejection), so memory stays
+        at max_memory however many frames the filter has.
+        """
+        try:
+            if self.master_bias is None:
+                raise ValueError("Master bias not loaded")
+            normalized_flat = load_master_frame(self.get_master_flat(filter_name), normalize=True, dtype=self.dtype)
+
+            header = None
+            n_frames = 0
+            calibrated = np.empty(self.master_bias.shape, dtype=self.dtype)
+            with DiskStack(len(frame_list), self.master_bias.shape, dtype=self.dtype, directory=self.scratch_dir) as stack:
+                for file_path in frame_list:
+                    data, frame_header = open_frame(file_path)
+                    if data is None:
+                        continue
+                    if header is None:
+                        header = frame_header
+                    np.subtract(data, self.master_bias, out=calibrated, dtype=self.dtype)
+                    calibrated /= normalized_flat
+                    stack[n_frames] = calibrated
+                    n_frames += 1
+
+                if n_frames == 0:
+                    print(f"No valid data frames found for filter {filter_name}")
+                    return None, None
+
+                reduced_frame = combine_frames(stack.frames[:n_frames], method=self.combine_method, dtype=self.dtype,
+                                               max_memory=self.max_memory, workers=self.workers)
+            print(f"Calibrated and stacked {n_frames} frames for filter {filter_name}")
+            return reduced_frame, header
+
+        except Exception as e:
+            print(f"Error reducing frames for filter {filter_name}: {e}")
+            return None, None
+
     def plot_reduced_image(self, reduced_data, filter_name, output_dir):
         """Plot the final reduced science image with appropriate scaling for astronomical objects."""
         try:
@@ -111,22 +187,12 @@ class ScienceFrameProcessor:
         print(f"\nSearching for science frames in directory: {self.base_dir}")
         
         try:
-            # First, find all science frames
-            for root, dirs, files in os.walk(self.base_dir):
-                fits_files = [f for f in files if f.endswith('.fits')]
-                if fits_files:
-                    print(f"\nFound {len(fits_files)} FITS files in: {root}")
-                
-                for file in fits_files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        with fits.open(file_path) as hdul:
-                            header = hdul[0].header
-                            filter_name = self.get_filter_name(header)
-                            if filter_name and self.is_science_frame(header):
-                                self.found_files[filter_name].append(file_path)
-                    except Exception as e:
-                        print(f"Error processing {file_path}: {str(e)}")
+            # First, find all science frames: only new or changed files have their header read
+            self.index.refresh(self.base_dir)
+            for filter_name in self.filters:
+                self.found_files[filter_name] = self.index.science_frames(filter_name, root=self.base_dir)
+                if self.found_files[filter_name]:
+                    print(f"Found {len(self.found_files[filter_name])} {filter_name} science frames")
 
             # Create output directory
             output_dir = os.path.join(os.path.dirname(self.base_dir), 'Reduced_Images')
@@ -141,7 +207,7 @@ class ScienceFrameProcessor:
                     if reduced_data is not None:
                         # Save reduced data
                         output_file = os.path.join(output_dir, f"Reduced_{filter_name}_science_image.fits")
-                        fits.writeto(output_file, reduced_data, header, overwrite=True)
+                        output_file = write_frame(output_file, reduced_data, header, storage=self.storage, **self.storage_options)
                         print(f"Saved reduced data to: {output_file}")
                         
                         # Plot reduced image
@@ -150,40 +216,13 @@ class ScienceFrameProcessor:
         except Exception as e:
             print(f"Error during processing: {e}")
 
-    def is_science_frame(self, header):
-        """Check if the frame is a science frame."""
-        frame_type = header.get('IMAGETYP', '').lower()
-        object_name = header.get('OBJECT', '').lower()
-        return object_name and not any(cal_type in frame_type for cal_type in ['bias', 'dark', 'flat'])
+    def is_science_frame(self, file_path):
+        """Check if the frame is a science frame (answered from the header index)."""
+        return self.index.is_science_frame(file_path)
 
-    def get_filter_name(self, header):
-        """Get filter name from the FITS header."""
-        filter_keywords = ['FILTER', 'FILT', 'FILTER1', 'FILTERNAME']
-        filter_raw = None
-        
-        for keyword in filter_keywords:
-            if keyword in header:
-                filter_raw = str(header[keyword]).upper()
-                break
-        
-        if not filter_raw:
-            return None
-        
-        filter_map = {
-            'B': ['B', 'BLUE', 'B-BAND'],
-            'V': ['V', 'VISUAL', 'V-BAND'],
-            'R': ['R', 'RED', 'R-BAND'],
-            'U': ['U', 'ULTRAVIOLET', 'U-BAND'],
-            'HALPHA': ['HALPHA', 'HA', 'H-ALPHA'],
-            'OIII': ['OIII', 'O-III', 'O III', '[OIII]'],
-            'SII': ['SII', 'S-II', 'S II', '[SII]']
-        }
-        
-        for std_name, variations in filter_map.items():
-            if any(var in filter_raw for var in variations):
-                return std_name
-                
-        return None
+    def get_filter_name(self, file_path):
+        """Get the standard filter name of a frame (answered from the header index)."""
+        return self.index.filter_name(file_path)
 
 def main():
     base_dir = r'C:\Users\finla\OneDrive - University of Edinburgh\Telescope Group Project\observation data\NGC7789'